@@ -0,0 +1,93 @@
+'''
+static asset bundles.
+
+Each page's stylesheets are concatenated and minified into one bundle
+named after a hash of its content, e.g. static/build/show.1a2b3c4d.css,
+which app.yaml serves with far-future expiration headers.  Build them
+before deploying with:
+
+    python assets.py
+
+which also writes the bundle urls to assets_manifest.json.  Templates
+use `stylesheets(bundle)` to get the urls to link to; the hashed bundle
+if it was built, otherwise the source files one by one.
+'''
+
+import os
+import re
+import json
+import hashlib
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STATIC = os.path.join(ROOT, 'static')
+BUILD = os.path.join(STATIC, 'build')
+# kept out of the static dirs, app engine doesn't let the app read files
+# that are served as static files
+MANIFEST = os.path.join(ROOT, 'assets_manifest.json')
+
+BUNDLES = {
+    'main': ['css/grid.css', 'css/media-queries.css', 'css/style.css'],
+    'show': ['css/grid.css', 'css/media-queries.css', 'css/show.css'],
+}
+
+_manifest = None
+
+
+def load_manifest():
+    '''returns the bundle -> url manifest written by `build`, or {}'''
+    global _manifest
+    if _manifest is None:
+        try:
+            with open(MANIFEST) as f:
+                _manifest = json.load(f)
+        except IOError:
+            _manifest = {}
+    return _manifest
+
+
+def stylesheets(bundle):
+    '''returns the list of stylesheet urls to link for a bundle'''
+    url = load_manifest().get(bundle)
+    if url:
+        return [url]
+    return ['/static/%s' % path for path in BUNDLES[bundle]]
+
+
+def minify_css(css):
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    # innermost {...} blocks are declarations, safe to drop spaces around
+    # ':' there (in selectors it could be a descendant combinator)
+    css = re.sub(r'\{[^{}]*\}', lambda m: re.sub(r'\s*:\s*', ':', m.group(0)), css)
+    css = css.replace(';}', '}')
+    return css.strip()
+
+
+def build():
+    '''builds all bundles and the manifest, returns the manifest'''
+    if not os.path.isdir(BUILD):
+        os.makedirs(BUILD)
+    manifest = {}
+    for name, paths in sorted(BUNDLES.items()):
+        parts = []
+        for path in paths:
+            with open(os.path.join(STATIC, path)) as f:
+                parts.append(minify_css(f.read()))
+        css = '\n'.join(parts)
+        digest = hashlib.sha1(css).hexdigest()[:10]
+        filename = '%s.%s.css' % (name, digest)
+        with open(os.path.join(BUILD, filename), 'w') as f:
+            f.write(css)
+        manifest[name] = '/static/build/%s' % filename
+        print "%s: %d files, %d bytes -> %s" % (name, len(paths), len(css), filename)
+
+    # bundles from earlier builds are left in place, pages cached by
+    # browsers may still link to them.
+    with open(MANIFEST, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+if __name__ == '__main__':
+    build()
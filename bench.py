@@ -0,0 +1,267 @@
+'''
+offline benchmarks for the app.
+
+Drives `main.app` in-process through WSGI, with the datastore and memcache
+stubbed by the app engine testbed and dwolla replaced by a
+`dwolla.FakeDwollaTransport` (set in the app registry, see
+`BaseHandler.dwolla_transport`).  Needs the app engine SDK, pass its path
+with `--sdk` (or set `APPENGINE_SDK`) unless it's already importable:
+
+    python bench.py --sdk ~/google_appengine
+    python bench.py -n 500 --latency 0.05 --error-rate 0.01 --concurrency 4
+
+Reports requests/sec and p50/p95/p99 latency per scenario, and saves the
+results as json under bench_results/, compared against the previous run
+(or `--baseline`) so regressions show up run to run.
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import datetime
+import threading
+import subprocess
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+RESULTS = os.path.join(ROOT, 'bench_results')
+
+SCENARIOS = ['show', 'new', 'new_post', 'oauth_cb', 'gateway']
+
+
+def setup_sdk(sdk=None):
+    '''puts the app engine SDK and its bundled libraries on sys.path'''
+    sdk = sdk or os.environ.get('APPENGINE_SDK')
+    if sdk:
+        sys.path.insert(0, os.path.expanduser(sdk))
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+    sys.path.insert(0, ROOT)
+
+
+def setup_testbed():
+    '''activates the testbed stubs main.py needs, returns the testbed'''
+    try:
+        from google.appengine.ext import testbed
+    except ImportError:
+        sys.exit("the app engine SDK isn't importable, pass its path with --sdk")
+    tb = testbed.Testbed()
+    tb.activate()
+    tb.setup_env(current_version_id='bench.1', overwrite=True)
+    tb.init_datastore_v3_stub()
+    tb.init_memcache_stub()
+    tb.init_taskqueue_stub(root_path=ROOT)
+    return tb
+
+
+class Scenarios(object):
+    '''
+    The requests to time, one method per scenario, each returning
+    `(method, path, POST data)`.
+    '''
+    def __init__(self, items=50):
+        import models
+        self.items = []
+        for i in range(items):
+            item = models.Item.create('812-111-1111', '%d.00' % (i + 1),
+                u'benchmark item **%d**' % i)
+            item.put()
+            self.items.append(item)
+        self.posts = 0
+
+    def show(self):
+        return 'GET', '/?k=%s' % random.choice(self.items).url_key(), None
+
+    def new(self):
+        return 'GET', '/new', None
+
+    def new_post(self):
+        self.posts += 1
+        return 'POST', '/new', {'dwolla_id': '812-111-1111',
+            'amount': '%d.50' % (self.posts % 100 + 1),
+            'text': u'posted item %d' % self.posts}
+
+    def oauth_cb(self):
+        return 'GET', '/oauth_cb?code=bench%d' % random.randint(0, 1 << 30), None
+
+    def gateway(self):
+        return 'GET', '/gateway?error=failure&error_description=declined', None
+
+
+def send(app, method, path, post=None):
+    import webapp2
+    request = webapp2.Request.blank(path, POST=post,
+        base_url='http://localhost:8080')
+    request.method = method
+    return request.get_response(app)
+
+
+def percentile(sorted_values, p):
+    '''nearest-rank percentile of an already sorted list'''
+    if not sorted_values:
+        return 0.0
+    k = max(0, int(round(p / 100.0 * len(sorted_values))) - 1)
+    return sorted_values[min(k, len(sorted_values) - 1)]
+
+
+def run_scenario(app, make_request, requests, concurrency=1, warmup=10):
+    '''
+    sends `requests` requests made by `make_request` (after `warmup`
+    untimed ones) from `concurrency` threads, returns the stats dict.
+    '''
+    for i in range(warmup):
+        send(app, *make_request())
+
+    latencies, statuses = [], {}
+    lock = threading.Lock()
+    remaining = [requests]
+
+    def worker():
+        while True:
+            with lock:
+                if not remaining[0]:
+                    return
+                remaining[0] -= 1
+                args = make_request()
+            start = time.time()
+            resp = send(app, *args)
+            elapsed = time.time() - start
+            with lock:
+                latencies.append(elapsed)
+                statuses[resp.status_int] = statuses.get(resp.status_int, 0) + 1
+
+    start = time.time()
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.time() - start
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'rps': len(latencies) / wall if wall else 0.0,
+        'p50': percentile(latencies, 50) * 1000,
+        'p95': percentile(latencies, 95) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+        'errors': sum(n for status, n in statuses.items() if status >= 500),
+        'statuses': dict((str(k), v) for k, v in statuses.items()),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=ROOT, stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save(results):
+    '''writes the results to bench_results/, returns the file name'''
+    if not os.path.isdir(RESULTS):
+        os.makedirs(RESULTS)
+    name = '%s-%s.json' % (results['started'].replace(':', '').replace('-', ''),
+        results['revision'] or 'norev')
+    path = os.path.join(RESULTS, name)
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    return path
+
+
+def latest_result():
+    '''path of the most recent saved result, or None'''
+    if not os.path.isdir(RESULTS):
+        return None
+    names = sorted(n for n in os.listdir(RESULTS) if n.endswith('.json'))
+    return os.path.join(RESULTS, names[-1]) if names else None
+
+
+def report(results, baseline=None):
+    base = (baseline or {}).get('scenarios', {})
+    print "%-10s %8s %9s %9s %9s %7s" % ('scenario', 'rps', 'p50 ms', 'p95 ms', 'p99 ms', 'errors')
+    for name in SCENARIOS:
+        stats = results['scenarios'].get(name)
+        if stats is None:
+            continue
+        print "%-10s %8.1f %9.2f %9.2f %9.2f %7d" % (name, stats['rps'],
+            stats['p50'], stats['p95'], stats['p99'], stats['errors'])
+        if name in base:
+            old = base[name]
+            delta = lambda key: (stats[key] - old[key]) / old[key] * 100 if old[key] else 0.0
+            print "%-10s %+7.1f%% %+8.1f%% %+8.1f%% %+8.1f%%" % ('', delta('rps'),
+                delta('p50'), delta('p95'), delta('p99'))
+    if baseline:
+        print "(changes vs %s, %s)" % (baseline.get('revision'), baseline.get('started'))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='benchmark the app offline')
+    parser.add_argument('-n', '--requests', type=int, default=200,
+        help='timed requests per scenario (default 200)')
+    parser.add_argument('-c', '--concurrency', type=int, default=1,
+        help='client threads (default 1)')
+    parser.add_argument('--warmup', type=int, default=10,
+        help='untimed requests per scenario first (default 10)')
+    parser.add_argument('--latency', type=float, default=0.0,
+        help='fake dwolla latency in seconds (default 0)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+        help='fraction of fake dwolla requests failing with a 503 (default 0)')
+    parser.add_argument('--items', type=int, default=50,
+        help='number of items the show scenario picks from (default 50)')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+        help='scenario to run, may be repeated (default all)')
+    parser.add_argument('--baseline', help='saved result to compare with '
+        '(default the most recent one)')
+    parser.add_argument('--no-save', action='store_true',
+        help="don't save the results")
+    parser.add_argument('--sdk', help='path to the app engine SDK')
+    args = parser.parse_args(argv)
+
+    setup_sdk(args.sdk)
+    tb = setup_testbed()
+    logging.getLogger().setLevel(logging.CRITICAL)
+    try:
+        import dwolla
+        import main as app_main
+        app = app_main.app
+        fake = dwolla.FakeDwollaTransport(latency=args.latency, error_rate=args.error_rate)
+        app.registry['dwolla.transport'] = fake
+        scenarios = Scenarios(items=args.items)
+
+        results = {
+            'started': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
+            'revision': git_revision(),
+            'options': {
+                'requests': args.requests,
+                'concurrency': args.concurrency,
+                'warmup': args.warmup,
+                'latency': args.latency,
+                'error_rate': args.error_rate,
+                'items': args.items,
+            },
+            'scenarios': {},
+        }
+        for name in args.scenario or SCENARIOS:
+            results['scenarios'][name] = run_scenario(app, getattr(scenarios, name),
+                args.requests, args.concurrency, args.warmup)
+        results['dwolla_requests'] = fake.requests
+    finally:
+        tb.deactivate()
+
+    baseline_path = args.baseline or latest_result()
+    baseline = None
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if not args.no_save:
+        print "saved %s" % os.path.relpath(save(results), ROOT)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
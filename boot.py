@@ -0,0 +1,67 @@
+'''
+instance startup timing.
+
+Import this first in main.py, then call `mark(name)` after each startup
+phase; each phase is timed from the previous mark.  Later phases (like the
+warmup request priming caches) can use `with phase(name):` instead.  The
+timings are logged by `log()`, so cold start regressions show up in the
+logs of each release, and kept in memcache per app version for the stats
+page.
+'''
+
+import os
+import time
+import logging
+import threading
+
+STARTED = time.time()
+phases = []
+
+_last = STARTED
+_lock = threading.Lock()
+
+
+def mark(name):
+    '''records the time since the previous mark as phase `name`'''
+    global _last
+    with _lock:
+        now = time.time()
+        phases.append((name, now - _last))
+        _last = now
+
+
+class phase(object):
+    '''context manager timing the code it wraps as phase `name`'''
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        with _lock:
+            phases.append((self.name, time.time() - self.start))
+
+
+def summary():
+    '''returns the timings as a dict, with the phases in order'''
+    with _lock:
+        return {
+            'version': os.environ.get('CURRENT_VERSION_ID'),
+            'instance': os.environ.get('INSTANCE_ID'),
+            'phases': list(phases),
+            'total': sum(t for name, t in phases),
+        }
+
+
+def log():
+    s = summary()
+    logging.info("startup %.0fms (%s)", s['total'] * 1000,
+        ', '.join('%s %.0fms' % (name, t * 1000) for name, t in s['phases']))
+    try:
+        from google.appengine.api import memcache
+        memcache.set('boot:%s' % s['version'], s, namespace='stats')
+    except Exception:
+        logging.exception("could not store startup timings")
+    return s
@@ -0,0 +1,176 @@
+'''
+caching helpers for the app, like the checkout url cache used by
+`MainHandler`.  Uses dwolla's in process `LRUCache` in front of memcache.
+'''
+
+import time
+import hashlib
+import logging
+import threading
+import collections
+from google.appengine.api import memcache
+from dwolla.cache import LRUCache
+
+
+class CheckoutError(Exception):
+    '''Raised for a cached checkout failure, so we don't retry it right away.'''
+    pass
+
+
+class CheckoutURLCache(object):
+    '''
+    Caches the dwolla checkout url generated for an item, so we only ask
+    dwolla for a new one once the old one is about to expire, instead of on
+    every page view.
+
+    Entries live in memcache for `ttl` seconds, with a per instance
+    `LRUCache` in front of it.  Once an entry is older than `ttl - refresh`
+    seconds a single request (guarded by a memcache lock, and a thread lock
+    on each instance) regenerates it, everyone else keeps serving the old
+    url which is still valid.  If that fails the old url keeps being served
+    until it expires, and the refresh is retried after `error_ttl` seconds.
+    Failures without a url to fall back on are cached for `error_ttl`
+    seconds, so a dwolla outage doesn't turn into one request per visitor
+    either.
+    '''
+    namespace = 'checkout_url'
+
+    def __init__(self, ttl=30*60, refresh=5*60, error_ttl=10,
+            lock_timeout=15, wait=2.0, local_size=1024):
+        self.ttl = ttl
+        self.refresh = refresh
+        self.error_ttl = error_ttl
+        self.lock_timeout = lock_timeout
+        self.wait = wait
+        self.local = LRUCache(local_size)
+        self._locks = collections.defaultdict(threading.Lock)
+        self._locks_lock = threading.Lock()
+
+    def cache_key(self, item_key, amount, desc):
+        raw = u'%s|%s|%s' % (item_key, amount, desc)
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def get(self, item_key, amount, desc, create):
+        '''
+        returns the checkout url for the given item, calling `create()` to
+        generate a new one if there is no usable cached url.
+
+        :param create: callable returning a fresh checkout url.
+        '''
+        key = self.cache_key(item_key, amount, desc)
+        entry = self._lookup(key)
+        if entry and entry[1] > time.time():
+            return self._result(entry)
+
+        # missing, failed or due for a refresh.  only one request per
+        # instance gets past the thread lock, and only one instance gets
+        # the memcache lock.
+        lock = self._thread_lock(key)
+        if not lock.acquire(False):
+            return self._wait_for(key, entry)
+        try:
+            entry = self._lookup(key)
+            if entry and entry[1] > time.time():
+                return self._result(entry)
+            if not memcache.add('lock:' + key, 1, time=self.lock_timeout,
+                    namespace=self.namespace):
+                return self._wait_for(key, entry)
+            try:
+                entry = self._create(key, create, entry)
+            finally:
+                memcache.delete('lock:' + key, namespace=self.namespace)
+        finally:
+            lock.release()
+        return self._result(entry)
+
+    def invalidate(self, item_key, amount, desc):
+        key = self.cache_key(item_key, amount, desc)
+        self.local.delete(key)
+        memcache.delete(key, namespace=self.namespace)
+
+    def _thread_lock(self, key):
+        with self._locks_lock:
+            if len(self._locks) > 4 * self.local.maxsize:
+                self._locks.clear()
+            return self._locks[key]
+
+    def _lookup(self, key):
+        # entries are (url, refresh_at, error, expires_at)
+        entry = self.local.get(key)
+        if entry is None:
+            entry = memcache.get(key, namespace=self.namespace)
+            if entry is not None:
+                self._remember(key, entry)
+        return entry
+
+    def _remember(self, key, entry):
+        # keep the local copy no longer than the url stays valid
+        self.local.set(key, entry, max(1, entry[3] - time.time()))
+
+    def _store(self, key, entry, ttl):
+        self._remember(key, entry)
+        memcache.set(key, entry, time=ttl, namespace=self.namespace)
+
+    def _create(self, key, create, stale=None):
+        try:
+            url = create()
+        except Exception as e:
+            logging.warning("checkout url creation failed: %s", e)
+            now = time.time()
+            if stale and stale[0] and stale[3] > now:
+                # the old url is still good, keep it and try again later
+                entry = (stale[0], min(now + self.error_ttl, stale[3]), None, stale[3])
+                self._store(key, entry, max(1, int(stale[3] - now)))
+                return entry
+            entry = (None, now + self.error_ttl, str(e), now + self.error_ttl)
+            self._store(key, entry, self.error_ttl)
+            return entry
+        now = time.time()
+        entry = (url, now + self.ttl - self.refresh, None, now + self.ttl)
+        self._store(key, entry, self.ttl)
+        return entry
+
+    def _wait_for(self, key, stale):
+        # someone else is regenerating the url.  a stale url is still
+        # valid, so use it; otherwise poll for the new one for a bit.
+        if stale and stale[0]:
+            return stale[0]
+        deadline = time.time() + self.wait
+        while time.time() < deadline:
+            time.sleep(0.05)
+            entry = memcache.get(key, namespace=self.namespace)
+            if entry and entry[1] > time.time():
+                self._remember(key, entry)
+                return self._result(entry)
+        raise CheckoutError("timed out waiting for checkout url")
+
+    def _result(self, entry):
+        url, refresh_at, error, expires_at = entry
+        if error:
+            raise CheckoutError(error)
+        return url
+
+
+class PageCache(object):
+    '''
+    Cache for rendered pages (or page fragments), keyed by something that
+    changes whenever the content does, e.g. an etag.  In-process LRU in
+    front of memcache.
+    '''
+    namespace = 'page'
+
+    def __init__(self, ttl=60*60, local_size=256):
+        self.ttl = ttl
+        self.local = LRUCache(local_size)
+
+    def get(self, key):
+        html = self.local.get(key)
+        if html is None:
+            html = memcache.get(key, namespace=self.namespace)
+            if html is not None:
+                self.local.set(key, html, self.ttl)
+        return html
+
+    def set(self, key, html):
+        self.local.set(key, html, self.ttl)
+        memcache.set(key, html, time=self.ttl, namespace=self.namespace)
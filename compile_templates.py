@@ -0,0 +1,42 @@
+'''
+precompiles the jinja2 templates in templates/ into python modules in
+templates_compiled/, which the app loads instead of compiling templates
+from source on every new instance.  Run it before deploying:
+
+    python compile_templates.py
+
+The app falls back to compiling templates from source if
+templates_compiled/ doesn't exist.
+'''
+
+import os
+import sys
+import time
+import shutil
+import jinja2
+
+import config
+
+
+def compile_templates(settings=None):
+    settings = settings or config.dev['webapp2_extras.jinja2']
+    root = os.path.dirname(os.path.abspath(__file__))
+    source = os.path.join(root, settings['template_path'])
+    target = config.COMPILED_TEMPLATES
+
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader(source),
+        **settings['environment_args'])
+    if os.path.isdir(target):
+        shutil.rmtree(target)
+    os.makedirs(target)
+
+    start = time.time()
+    names = env.list_templates(extensions=['html'])
+    env.compile_templates(target, filter_func=lambda n: n in names,
+        zip=None, ignore_errors=False)
+    print "compiled %d templates into %s in %.2fs" % (len(names),
+        os.path.relpath(target, root), time.time() - start)
+
+
+if __name__ == '__main__':
+    compile_templates()
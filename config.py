@@ -1,7 +1,32 @@
+import os
+import assets
+
+# templates precompiled by compile_templates.py, loaded instead of the
+# sources in templates/ when present.
+COMPILED_TEMPLATES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'templates_compiled')
+
 dev = {
   "DWOLLA_API_KEY": "",
   "DWOLLA_API_SECRET": "",
   "DWOLLA_API_PERMISSIONS": "",
 
-  "webapp2_extras.sessions": {"secret_key": "my-super-secret-key"}
+  # seconds browsers and the edge cache may reuse an item page for
+  "PAGE_MAX_AGE": 60,
+
+  "webapp2_extras.sessions": {"secret_key": "my-super-secret-key"},
+
+  "webapp2_extras.jinja2": {
+    "template_path": "templates",
+    "compiled_path": COMPILED_TEMPLATES if os.path.isdir(COMPILED_TEMPLATES) else None,
+    "force_compiled": True,
+    # compiled templates bake these in, compile_templates.py uses them too
+    "environment_args": {
+      "autoescape": True,
+      "extensions": ["jinja2.ext.autoescape", "jinja2.ext.with_"],
+    },
+    "globals": {
+      "stylesheets": assets.stylesheets,
+    },
+  },
 }
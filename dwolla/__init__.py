@@ -10,14 +10,62 @@ http://developers.dwolla.com/
 
 import json
 import urllib
+import hashlib
 import datetime
-from google.appengine.api import urlfetch
+from dwolla.errors import (DwollaAPIError, DwollaUnavailableError,
+    RequestNotSentError, CircuitOpenError, RateLimitError)
+from dwolla.transport import (Transport, UrlfetchTransport, PooledTransport,
+    FakeDwollaTransport, get_default_transport, set_default_transport)
+from dwolla.futures import Future, MappedFuture, Executor, gather
+from dwolla.resilience import (ResilientTransport, TokenBucket,
+    CircuitBreaker, Retry)
+from dwolla.cache import LRUCache, ResponseCache, MISS
+from dwolla import singleflight
+from dwolla.singleflight import SingleFlight, flight_key
+from dwolla.stats import Stats, default_stats, endpoint_name
+from dwolla.records import (Transaction, TransactionTable, DATE_FORMATS,
+    parse_date)
+from dwolla.analytics import TransactionStats
+from dwolla.checkout import Cart, to_decimal
+
+# most transactions the api returns per request
+MAX_TRANSACTION_PAGE = 200
+
+def _fetch(client, endpoint, url, method='GET', payload=None, headers=None):
+    '''sends a request with the client's transport, recording it in its stats'''
+    if client.stats:
+        return client.stats.fetch(client.transport, endpoint_name(endpoint),
+            url, method, payload, headers)
+    return client.transport.fetch(url, method=method, payload=payload, headers=headers)
+
+
+def _fetch_async(client, endpoint, url, method='GET', payload=None, headers=None):
+    '''like `_fetch`, but returns a future'''
+    if client.stats:
+        return client.stats.fetch_async(client.transport, endpoint_name(endpoint),
+            url, method, payload, headers)
+    return client.transport.fetch_async(url, method=method, payload=payload, headers=headers)
+
+
+def _parse(client, endpoint, resp):
+    '''parses a response with the client, recording api errors in its stats'''
+    try:
+        return client.parse_response(resp)
+    except DwollaAPIError as e:
+        if client.stats:
+            client.stats.record_error(endpoint_name(endpoint), e)
+        raise
+
 
 class DwollaGateway(object):
-    def __init__(self, client_id, client_secret, redirect_uri):
+    # requests are recorded here (see `dwolla.stats`), None to turn it off
+    stats = default_stats
+
+    def __init__(self, client_id, client_secret, redirect_uri, transport=None):
         self.client_id = client_id
         self.client_secret = client_secret
         self.redirect_uri = redirect_uri
+        self.transport = transport or get_default_transport()
         self.session = []
         self.mode = 'LIVE'
 
@@ -45,15 +93,23 @@ class DwollaGateway(object):
     def get_gateway_URL(self, destination_id, order_id=None,
             discount=0, shipping=0, tax=0, notes=None, callback=None,
             allow_funding_sources=0):
-        # Calcualte subtotal
-        subtotal = 0
+        '''
+        returns a checkout url for the products added since
+        `start_gateway_session`.  See `create_checkout` for doing the same
+        with a `Cart`, which is safe to use from several threads.
+        '''
+        cart = Cart(destination_id, order_id=order_id, discount=discount,
+            shipping=shipping, tax=tax, notes=notes, callback=callback)
         for product in self.session:
-            subtotal += float(product['Price']) * float(product['Quantity'])
-
-        # Calculate grand total
-        total = subtotal - discount + shipping + tax
-
+            cart.add(product['Name'], product['Price'],
+                desc=product['Description'], qty=product['Quantity'])
+        return self.create_checkout(cart)
 
+    def create_checkout(self, cart):
+        '''
+        Asks dwolla for a checkout of a `Cart`, returns the url to send the
+        customer to.  Raises `DwollaAPIError` if dwolla refuses the order.
+        '''
         # Create request body
         request = {}
         request['Key'] = self.client_id
@@ -61,40 +117,51 @@ class DwollaGateway(object):
         request['Test'] = 'true' if (self.mode == 'TEST') else 'false'
         request['AllowFundingSources'] = "true"
         request['Redirect'] = self.redirect_uri
-        request['PurchaseOrder'] = {}
-        request['PurchaseOrder']['DestinationId'] = destination_id
-        request['PurchaseOrder']['OrderItems'] = self.session
-        request['PurchaseOrder']['Discount'] = -discount
-        request['PurchaseOrder']['Shipping'] = shipping
-        request['PurchaseOrder']['Tax'] = tax
-
-        request['PurchaseOrder']['Total'] = round(total, 2)
+        request['PurchaseOrder'] = cart.purchase_order()
 
         # Append optional parameters
-        if order_id:
-            request['OrderId'] = order_id
-        if callback:
-            request['Callback'] = callback
-        if notes:
-            request['PurchaseOrder']['Notes'] = notes
+        if cart.order_id:
+            request['OrderId'] = cart.order_id
+        if cart.callback:
+            request['Callback'] = cart.callback
 
         # Send off the request
         headers = {'Content-Type': 'application/json'}
         data = json.dumps(request)
 
-        #response = requests.post(, verify=True)
-        response = urlfetch.fetch(url='https://www.dwolla.com/payment/request',
-            method=urlfetch.POST,
+        response = _fetch(self, 'payment/request',
+            'https://www.dwolla.com/payment/request',
+            method='POST',
             payload=data,
             headers=headers
         )
         # Parse the response
         response = json.loads(response.content)
         if response['Result'] != 'Success':
-            raise DwollaAPIError(response['Message'])
+            error = DwollaAPIError(response['Message'])
+            if self.stats:
+                self.stats.record_error('payment/request', error)
+            raise error
 
         return 'https://www.dwolla.com/payment/checkout/%s' % response['CheckoutId']
 
+    def create_checkouts(self, carts, concurrency=10):
+        '''
+        Creates checkouts for many carts, at most `concurrency` requests at
+        a time.  Returns a list of `(order_id, url, error)` tuples in the
+        order of `carts`; for each cart either `url` or the exception
+        (`error`) is set, one failed order doesn't stop the others.
+        '''
+        executor = Executor(max_workers=concurrency)
+        futures = executor.map(self.create_checkout, carts)
+        results = []
+        for cart, future in zip(carts, futures):
+            try:
+                results.append((cart.order_id, future.get_result(), None))
+            except Exception as e:
+                results.append((cart.order_id, None, e))
+        return results
+
     def verify_gateway_signature(self, signature, checkout_id, amount):
         import hmac
         import hashlib
@@ -107,18 +174,21 @@ class DwollaGateway(object):
         return True if (hash == signature) else False
 
 
-class DwollaAPIError(Exception):
-    '''Raised if the dwolla api returns an error.'''
-    pass
-
-
 class DwollaClientApp(object):
     '''
     Encapsulates OAuth dance, and making requests to the dwolla api.
     '''
-    def __init__(self, client_id, client_secret):
+    # concurrent identical `get` calls share one request, set to None
+    # to turn that off.
+    flights = singleflight.default_group
+    # requests are recorded here (see `dwolla.stats`), None to turn it off
+    stats = default_stats
+
+    def __init__(self, client_id, client_secret, transport=None, cache=None):
         self.client_id = client_id
         self.client_secret = client_secret
+        self.transport = transport or get_default_transport()
+        self.cache = cache
         self.api_url = "https://www.dwolla.com/oauth/rest/"
         self.auth_url = "https://www.dwolla.com/oauth/v2/authenticate"
         self.token_url = "https://www.dwolla.com/oauth/v2/token"
@@ -187,15 +257,17 @@ class DwollaClientApp(object):
         }
         if 'redirect_uri' in kwargs:
             params['redirect_uri'] = kwargs['redirect_uri']
-        #resp = requests.get(, params=params, verify=True)
         _url = "%s?%s" % (self.token_url, urllib.urlencode(params))
-        resp = urlfetch.fetch(_url)
+        resp = _fetch(self, 'oauth/token', _url)
         resp = json.loads(resp.content)
         try:
             return resp['access_token']
         except:
             err_msg = "<%(error)s>: %(error_description)s" % resp
-            raise DwollaAPIError(err_msg)
+            error = DwollaAPIError(err_msg)
+            if self.stats:
+                self.stats.record_error('oauth/token', error)
+            raise error
 
     def api_request(self, resource, **params):
         '''
@@ -206,14 +278,14 @@ class DwollaClientApp(object):
         params['client_secret'] = self.client_secret
         url = "%s/%s" % (self.api_url, resource)
         _url = "%s?%s" % (url, urllib.urlencode(params))
-        return urlfetch.fetch(_url)
+        return _fetch(self, resource, _url)
 
     def api_post(self, endpoint, data):
         url = "%s%s" % (self.api_url, endpoint)
         headers = {'Content-Type': 'application/json'}
         data = json.dumps(data)
 
-        return urlfetch.fetch(url, method=urlfetch.POST, payload=data, headers=headers)
+        return _fetch(self, endpoint, url, method='POST', payload=data, headers=headers)
 
     def get(self, resource, **params):
         '''
@@ -227,12 +299,24 @@ class DwollaClientApp(object):
             on the kind of resource being fetched (.e.g range=10, limit=10,
             etc.)
         '''
-        resp = self.api_request(resource, **params)
-        return self.parse_response(resp)
+        if self.cache:
+            cached = self.cache.get(self.client_id, resource, params)
+            if self.stats and self.cache.ttl(resource):
+                self.stats.record_cache(endpoint_name(resource), cached is not MISS)
+            if cached is not MISS:
+                return cached
+        fetch = lambda: _parse(self, resource, self.api_request(resource, **params))
+        if self.flights:
+            result = self.flights.do(flight_key(self.client_id, resource, params), fetch)
+        else:
+            result = fetch()
+        if self.cache:
+            self.cache.set(self.client_id, resource, params, result)
+        return result
 
     def post(self, endpoint, data):
         resp = self.api_post(endpoint, data)
-        return self.parse_response(resp)
+        return _parse(self, endpoint, resp)
 
     def get_account_info(self, account_id):
         '''
@@ -316,10 +400,19 @@ class DwollaUser(object):
     Once you have an access token for a specfic user, you can use it
     to instatiate this class, ehich wraps usefull api resources/functions.
     '''
+    # concurrent identical `get` calls share one request, set to None
+    # to turn that off.
+    flights = singleflight.default_group
+    # requests are recorded here (see `dwolla.stats`), None to turn it off
+    stats = default_stats
 
-    def __init__(self, access_token):
+    def __init__(self, access_token, transport=None, cache=None):
         self.api_url = "https://www.dwolla.com/oauth/rest"
         self.access_token = access_token
+        self.transport = transport or get_default_transport()
+        self.cache = cache
+        # cached responses are per user, but keep the token out of the keys
+        self.cache_scope = hashlib.sha1(access_token or '').hexdigest()
 
     def parse_response(self, resp):
         resp = json.loads(resp.content)
@@ -330,25 +423,74 @@ class DwollaUser(object):
     def api_get(self, endpoint, **params):
         url = "%s/%s" % (self.api_url, endpoint)
         params['oauth_token'] = self.access_token
-        #return requests.get(url, params=params, verify=True)
         _url = "%s?%s" % (url, urllib.urlencode(params))
-        return urlfetch.fetch(_url)
+        return _fetch(self, endpoint, _url)
 
     def api_post(self, endpoint, data):
         url = "%s/%s" % (self.api_url, endpoint)
         headers = {'Content-Type': 'application/json'}
         data['oauth_token'] = self.access_token
         data = json.dumps(data)
-        #return requests.post(url, data=data, headers=headers)
-        return urlfetch.fetch(url, method=urlfetch.POST, payload=data, headers=headers)
+        return _fetch(self, endpoint, url, method='POST', payload=data, headers=headers)
+
+    def api_get_async(self, endpoint, **params):
+        url = "%s/%s" % (self.api_url, endpoint)
+        params['oauth_token'] = self.access_token
+        _url = "%s?%s" % (url, urllib.urlencode(params))
+        return _fetch_async(self, endpoint, _url)
+
+    def api_post_async(self, endpoint, data):
+        url = "%s/%s" % (self.api_url, endpoint)
+        headers = {'Content-Type': 'application/json'}
+        data['oauth_token'] = self.access_token
+        data = json.dumps(data)
+        return _fetch_async(self, endpoint, url, method='POST', payload=data, headers=headers)
 
     def get(self, endpoint, **params):
-        resp = self.api_get(endpoint, **params)
-        return self.parse_response(resp)
+        if self.cache:
+            cached = self.cache.get(self.cache_scope, endpoint, params)
+            if self.stats and self.cache.ttl(endpoint):
+                self.stats.record_cache(endpoint_name(endpoint), cached is not MISS)
+            if cached is not MISS:
+                return cached
+        fetch = lambda: _parse(self, endpoint, self.api_get(endpoint, **params))
+        if self.flights:
+            result = self.flights.do(flight_key(self.cache_scope, endpoint, params), fetch)
+        else:
+            result = fetch()
+        if self.cache:
+            self.cache.set(self.cache_scope, endpoint, params, result)
+        return result
 
     def post(self, endpoint, data):
         resp = self.api_post(endpoint, data)
-        return self.parse_response(resp)
+        return _parse(self, endpoint, resp)
+
+    def get_async(self, endpoint, **params):
+        '''
+        Like `get`, but returns right away with a future. Call
+        `get_result()` on it to get the parsed response (or the error).
+        '''
+        if self.cache:
+            cached = self.cache.get(self.cache_scope, endpoint, params)
+            if self.stats and self.cache.ttl(endpoint):
+                self.stats.record_cache(endpoint_name(endpoint), cached is not MISS)
+            if cached is not MISS:
+                future = Future()
+                future.set_result(cached)
+                return future
+        rpc = self.api_get_async(endpoint, **params)
+        def parse(resp):
+            result = _parse(self, endpoint, resp)
+            if self.cache:
+                self.cache.set(self.cache_scope, endpoint, params, result)
+            return result
+        return MappedFuture(rpc, parse)
+
+    def post_async(self, endpoint, data):
+        '''Like `post`, but returns a future. See `get_async`.'''
+        rpc = self.api_post_async(endpoint, data)
+        return MappedFuture(rpc, lambda resp: _parse(self, endpoint, resp))
 
     def get_account_info(self):
         '''returs the account info for this user account'''
@@ -406,8 +548,58 @@ class DwollaUser(object):
 
         :param skip: (optional) Numer of transactions to skip. Defaults to 0.
         '''
-        if type(since) == datetime.datetime:
-            since = since.strformat("%m-%d-%Y")
+        params = self._transaction_params(since, types, limit, skip)
+        return self.get("transactions", **params)
+
+    def iter_transactions(self, since="", types="", page_size=MAX_TRANSACTION_PAGE):
+        '''
+        Generator over all transactions since a given date, fetching them
+        page by page as needed.  While one page is being consumed the next
+        one is already being fetched, and at most two pages are held in
+        memory at any time, no matter how long the history is.
+
+        :param since: (optional) Earliest date and time for which to retrieve
+            transactions. See `get_transaction_list`.
+
+        :param types: (optional) '|' delimited transaction types to retrieve.
+            See `get_transaction_list`.
+
+        :param page_size: (optional) Number of transactions to fetch per
+            request. Defaults to (and can be at most) 200.
+        '''
+        page_size = min(page_size, MAX_TRANSACTION_PAGE)
+        skip = 0
+        seen = set()
+        future = self.get_async("transactions",
+            **self._transaction_params(since, types, page_size, skip))
+        while future is not None:
+            page = future.get_result() or []
+            skip += len(page)
+            future = None
+            if len(page) == page_size:
+                future = self.get_async("transactions",
+                    **self._transaction_params(since, types, page_size, skip))
+            # transactions that come in while we page shift older ones
+            # onto the next page, so skip any we already returned.
+            ids = set()
+            for tx in page:
+                ids.add(tx.get('Id'))
+                if tx.get('Id') not in seen:
+                    yield tx
+            seen = ids
+
+    def load_transactions(self, since="", types="", page_size=MAX_TRANSACTION_PAGE):
+        '''
+        Fetches all transactions since a given date into a compact
+        `TransactionTable`.  Only the page being converted is ever held as
+        dicts, so this takes much less memory than keeping the dicts from
+        `iter_transactions`.  Takes the same arguments.
+        '''
+        return TransactionTable(self.iter_transactions(since, types, page_size))
+
+    def _transaction_params(self, since="", types="", limit=None, skip=None):
+        if isinstance(since, (datetime.date, datetime.datetime)):
+            since = since.strftime("%m-%d-%Y")
         params = {}
         if since:
             params['sinceDate'] = since
@@ -417,35 +609,50 @@ class DwollaUser(object):
             params['limit'] = limit
         if skip:
             params['skip'] = skip
-        return self.get("transactions", **params)
+        return params
 
     def get_transaction_stats(self, types=None, start_date="", end_date=""):
         '''
-        returns transaction stats for the user account.
+        returns transaction stats for the user account.  To compute stats
+        for many date ranges, or grouped by type, period or counterparty,
+        use `load_transaction_stats` instead.
+
+        :param types: (optional) Transaction types to include, delimited by
+            a '|'. See `get_transaction_list`.
 
         :param start_date: (optional) Starting date and time to for which to
             process transactions stats. Defaults to 0300 of the current day in
             UTC.  Can be string with format 'mm-dd-YYYY' or a python
-            `datetime.datetime` object.
+            `datetime.date` object.
 
-        :param end_date: (optional) Starting date and time to for which to
+        :param end_date: (optional) Ending date and time to for which to
             process transactions stats. Defaults to 0300 of the current day in
             UTC.  Can be string with format 'mm-dd-YYYY' or a python
-            `datetime.datetime` object.
+            `datetime.date` object.
         '''
-        if type(start_date) == datetime.datetime:
-            start_date = start_date.strformat("%m-%d-%Y")
-        if type(end_date) == datetime.datetime:
-            end_date = end_date.strformat("%m-%d-%Y")
+        if isinstance(start_date, datetime.date):
+            start_date = start_date.strftime("%m-%d-%Y")
+        if isinstance(end_date, datetime.date):
+            end_date = end_date.strftime("%m-%d-%Y")
         params = {}
         if types:
             params['types'] = types
-        if types:
+        if start_date:
             params['startDate'] = start_date
-        if types:
+        if end_date:
             params['endDate'] = end_date
         return self.get("transactions/stats", **params)
 
+    def load_transaction_stats(self, since="", types=""):
+        '''
+        Fetches all transactions since a given date (see `load_transactions`)
+        and returns a `TransactionStats` over them, which answers stats
+        queries for any date range within them without further requests.
+        '''
+        # not `get_account_info`, which returns a future on AsyncDwollaUser
+        account_id = str(DwollaUser.get(self, "users")['Id'])
+        return TransactionStats(self.load_transactions(since, types), account_id)
+
     def send_funds(self, amount, dest, pin,
             notes=None, assume_cost=None, facil_amount=None, dest_type=None, funds_source=None):
         '''
@@ -490,7 +697,10 @@ class DwollaUser(object):
         if funds_source:
             params['fundsSource'] = funds_source
 
-        return self.post('transactions/send', params)
+        try:
+            return self.post('transactions/send', params)
+        finally:
+            self.invalidate_balance()
 
     def request_funds(self, amount, source, pin,
             notes=None, facil_amount=None, source_type=None):
@@ -525,7 +735,15 @@ class DwollaUser(object):
             params['facilitatorAmount'] = facil_amount
         if source_type:
             params['sourceType'] = source_type
-        return self.post('transactions/request', params)
+        try:
+            return self.post('transactions/request', params)
+        finally:
+            self.invalidate_balance()
+
+    def invalidate_balance(self):
+        '''drops this user's cached balance, if a cache is used'''
+        if self.cache:
+            self.cache.invalidate(self.cache_scope, 'balance')
 
     def get_funding_sources(self):
         ''' Returns a list of verified funding sources for the user '''
@@ -539,3 +757,41 @@ class DwollaUser(object):
             being requested.
         '''
         return self.get("fundingsources/%s" % source_id)
+
+
+class AsyncDwollaUser(DwollaUser):
+    '''
+    Same as `DwollaUser`, except every api call returns a future instead
+    of blocking, so several calls can be in flight at once::
+
+        api = AsyncDwollaUser(token)
+        info, balance = dwolla.gather(api.get_account_info(), api.get_balance())
+
+    On App Engine the futures are urlfetch rpc's, elsewhere the requests run
+    on the transport's thread pool.
+    '''
+
+    def get(self, endpoint, **params):
+        return self.get_async(endpoint, **params)
+
+    def post(self, endpoint, data):
+        return self.post_async(endpoint, data)
+
+    def get_overview(self, **transaction_params):
+        '''
+        Fetches everything an account overview page needs concurrently, and
+        returns it as a dict with `account`, `balance`, `contacts`,
+        `funding_sources` and `transactions` keys.  Takes as long as the
+        slowest of the calls, not the sum of them.
+
+        :param **transaction_params: optional arguments passed on to
+            `get_transaction_list`.
+        '''
+        keys = ['account', 'balance', 'contacts', 'funding_sources', 'transactions']
+        results = gather(
+            self.get_account_info(),
+            self.get_balance(),
+            self.get_contacts(),
+            self.get_funding_sources(),
+            self.get_transaction_list(**transaction_params))
+        return dict(zip(keys, results))
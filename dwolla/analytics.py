@@ -0,0 +1,252 @@
+'''
+Transaction statistics computed locally.
+
+`TransactionStats` answers the questions `DwollaUser.get_transaction_stats`
+asks dwolla, and more (by type, by day/week/month, by counterparty), from
+transactions that were already fetched, so any number of date ranges cost
+no requests::
+
+    stats = dwolla.TransactionStats(api.load_transactions(since=last_year))
+    stats.stats(types='money_received', start_date=datetime.date(2012, 3, 1))
+    # {'TransactionsCount': 12, 'TransactionsTotal': 140.5}
+    stats.by_period('month', types='money_received')
+
+Amounts are added up in cents, so totals are exact.  The work is done
+with numpy arrays when numpy is available (on App Engine, add it to the
+`libraries` in app.yaml), and with plain python loops otherwise, with
+the same results.
+'''
+
+import datetime
+import calendar
+
+PERIODS = ('day', 'week', 'month')
+
+_numpy = None
+
+
+def get_numpy():
+    '''returns the numpy module, or None if it isn't installed'''
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+        _numpy = numpy
+    return _numpy or None
+
+
+def _bound(value, end=False):
+    '''
+    turns a date range bound into a timestamp.  Dates (and 'mm-dd-YYYY'
+    strings) mean whole days like for the api, so an end date includes
+    that day.  Datetimes are used as they are.
+    '''
+    if not value:
+        return None
+    if isinstance(value, basestring):
+        value = datetime.datetime.strptime(value, '%m-%d-%Y').date()
+    if isinstance(value, datetime.datetime):
+        return calendar.timegm(value.timetuple())
+    if end:
+        value += datetime.timedelta(days=1)
+    return calendar.timegm(value.timetuple())
+
+
+class TransactionStats(object):
+    '''
+    Statistics over the transactions of one account.
+
+    :param table: `TransactionTable` (or an iterable of transaction dicts).
+
+    :param account_id: (optional) dwolla id of the account, to tell the
+        counterparty of a transaction apart from the account itself.  If
+        not given, it's taken to be the id seen most often.
+
+    :param use_numpy: (optional) set to False to not use numpy even if it
+        is available.
+    '''
+    def __init__(self, table, account_id=None, use_numpy=True):
+        from dwolla.records import TransactionTable
+        if not isinstance(table, TransactionTable):
+            table = TransactionTable(table)
+        self.table = table
+        self.np = get_numpy() if use_numpy else None
+
+        sources = table.column('source_id')
+        destinations = table.column('destination_id')
+        if account_id is None:
+            seen = {}
+            for ids in (sources, destinations):
+                for i in ids:
+                    seen[i] = seen.get(i, 0) + 1
+            account_id = max(seen, key=seen.get) if seen else None
+        self.account_id = account_id
+
+        self.types, type_codes = self._encode(table.column('type'))
+        self.counterparties, party_codes = self._encode([
+            dest if source == account_id else source
+            for source, dest in zip(sources, destinations)])
+        cents = [int(round(amount * 100)) for amount in table.amounts]
+        timestamps = table.timestamps
+        dated = [d is not None for d in table.dates]
+        months = [d.year * 12 + d.month - 1 if d else 0 for d in table.dates]
+        if self.np:
+            np = self.np
+            self.type_codes = np.array(type_codes, dtype=np.int64)
+            self.party_codes = np.array(party_codes, dtype=np.int64)
+            self.cents = np.array(cents, dtype=np.int64)
+            self.timestamps = np.frombuffer(timestamps, dtype=np.float64)
+            self.months = np.array(months, dtype=np.int64)
+            self.dated = np.array(dated, dtype=bool)
+        else:
+            self.type_codes = type_codes
+            self.party_codes = party_codes
+            self.cents = cents
+            self.timestamps = timestamps
+            self.months = months
+            self.dated = dated
+
+    def _encode(self, values):
+        '''returns the distinct values, and each value's index among them'''
+        labels, index, codes = [], {}, []
+        for value in values:
+            code = index.get(value)
+            if code is None:
+                code = index[value] = len(labels)
+                labels.append(value)
+            codes.append(code)
+        return labels, codes
+
+    def _type_codes(self, types):
+        if isinstance(types, basestring):
+            types = types.split('|')
+        return [self.types.index(t) for t in types if t in self.types]
+
+    def _select(self, types=None, start_date=None, end_date=None):
+        '''
+        returns the rows matching the filters, as a mask (or index list).
+        Transactions without a date are only included without a date range.
+        '''
+        start, end = _bound(start_date), _bound(end_date, end=True)
+        codes = self._type_codes(types) if types else None
+        if self.np:
+            np = self.np
+            mask = np.ones(len(self.cents), dtype=bool)
+            if codes is not None:
+                mask &= np.in1d(self.type_codes, codes)
+            if start is not None or end is not None:
+                mask &= self.dated
+            if start is not None:
+                mask &= self.timestamps >= start
+            if end is not None:
+                mask &= self.timestamps < end
+            return mask
+        codes = set(codes) if codes is not None else None
+        bounded = start is not None or end is not None
+        rows = []
+        for i, ts in enumerate(self.timestamps):
+            if codes is not None and self.type_codes[i] not in codes:
+                continue
+            if bounded and not self.dated[i]:
+                continue
+            if start is not None and ts < start:
+                continue
+            if end is not None and ts >= end:
+                continue
+            rows.append(i)
+        return rows
+
+    def _group(self, keys, rows):
+        '''returns {key: (count, cents)} over the selected rows'''
+        if self.np:
+            np = self.np
+            selected = keys[rows]
+            if not len(selected):
+                return {}
+            unique, inverse = np.unique(selected, return_inverse=True)
+            counts = np.bincount(inverse)
+            totals = np.bincount(inverse, weights=self.cents[rows])
+            return dict((int(k), (int(n), int(round(t))))
+                for k, n, t in zip(unique, counts, totals))
+        groups = {}
+        for i in rows:
+            count, total = groups.get(keys[i], (0, 0))
+            groups[keys[i]] = (count + 1, total + self.cents[i])
+        return groups
+
+    def _result(self, count, cents):
+        return {'TransactionsCount': count, 'TransactionsTotal': cents / 100.0}
+
+    def stats(self, types=None, start_date=None, end_date=None):
+        '''
+        Same as `DwollaUser.get_transaction_stats`, but computed locally:
+        returns `TransactionsCount` and `TransactionsTotal` for the
+        transactions of the given types in the date range.
+
+        :param types: (optional) '|' delimited string, or list of
+            transaction types to include. Defaults to all.
+
+        :param start_date: (optional) first day (a `datetime.date` or
+            'mm-dd-YYYY' string) or exact time (`datetime.datetime`) to
+            include.
+
+        :param end_date: (optional) last day to include, or the exact time
+            (excluded) to stop at.
+        '''
+        rows = self._select(types, start_date, end_date)
+        if self.np:
+            return self._result(int(rows.sum()), int(self.cents[rows].sum()))
+        return self._result(len(rows), sum(self.cents[i] for i in rows))
+
+    def by_type(self, start_date=None, end_date=None):
+        '''returns the stats (see `stats`) per transaction type'''
+        groups = self._group(self.type_codes, self._select(None, start_date, end_date))
+        return dict((self.types[code], self._result(*group))
+            for code, group in groups.items())
+
+    def fees(self, start_date=None, end_date=None):
+        '''returns the stats of the 'fee' transactions'''
+        return self.stats('fee', start_date, end_date)
+
+    def by_counterparty(self, types=None, start_date=None, end_date=None):
+        '''returns the stats per counterparty (the other account's id)'''
+        groups = self._group(self.party_codes, self._select(types, start_date, end_date))
+        return dict((self.counterparties[code], self._result(*group))
+            for code, group in groups.items())
+
+    def by_period(self, period='day', types=None, start_date=None, end_date=None):
+        '''
+        returns a list of `(date, stats)` per day, week (starting on
+        mondays) or month, oldest first.  Periods without transactions are
+        left out, and so are transactions without a date.
+        '''
+        if period not in PERIODS:
+            raise ValueError("period must be one of %s" % ', '.join(PERIODS))
+        rows = self._select(types, start_date, end_date)
+        if self.np:
+            rows = rows & self.dated
+        else:
+            rows = [i for i in rows if self.dated[i]]
+        if period == 'month':
+            keys = self.months
+        elif self.np:
+            days = (self.timestamps // 86400).astype(self.np.int64)
+            # day 0 (1970-01-01) was a thursday
+            keys = (days + 3) // 7 if period == 'week' else days
+        else:
+            days = [int(ts // 86400) for ts in self.timestamps]
+            keys = [(d + 3) // 7 for d in days] if period == 'week' else days
+        groups = self._group(keys, rows)
+        epoch = datetime.date(1970, 1, 1)
+        result = []
+        for key in sorted(groups):
+            if period == 'month':
+                date = datetime.date(key // 12, key % 12 + 1, 1)
+            elif period == 'week':
+                date = epoch + datetime.timedelta(days=key * 7 - 3)
+            else:
+                date = epoch + datetime.timedelta(days=key)
+            result.append((date, self._result(*groups[key])))
+        return result
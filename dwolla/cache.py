@@ -0,0 +1,170 @@
+'''
+Response caching for read-only dwolla endpoints.
+
+Pass a `ResponseCache` as the `cache` argument of `DwollaClientApp` or
+`DwollaUser` to turn it on.  Only endpoints listed in the cache's `ttls`
+are cached, everything else always goes to dwolla.  Entries are kept in a
+bounded in-process `LRUCache`, and optionally in memcache as well::
+
+    from google.appengine.api import memcache
+    responses = dwolla.ResponseCache(memcache=memcache)
+    api = dwolla.DwollaUser(token, cache=responses)
+
+`DwollaUser.send_funds` and `request_funds` drop the cached balance of
+that user.  Other instances' in-process copies are only dropped once their
+ttl runs out, so keep the ttls of endpoints like `balance` short.
+'''
+
+import copy
+import json
+import time
+import hashlib
+import threading
+import collections
+
+MISS = object()
+
+
+class LRUCache(object):
+    '''
+    Small thread safe in-process cache, bounded to `maxsize` entries. Each
+    entry has its own expiry time, expired entries are dropped on access.
+    '''
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires and expires < time.time():
+                return default
+            self._data[key] = (value, expires)
+            return value
+
+    def set(self, key, value, ttl=0):
+        expires = time.time() + ttl if ttl else 0
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ResponseCache(object):
+    '''
+    Caches parsed api responses per endpoint.
+
+    :param ttls: (optional) dict mapping endpoints to the number of seconds
+        their responses are cached for.  An endpoint like `users/812-...`
+        matches an entry for `users` if there's none for the full path.
+        Defaults to `DEFAULT_TTLS`.
+
+    :param maxsize: (optional) maximum number of responses kept in process.
+        Defaults to 1000.
+
+    :param memcache: (optional) memcache client (e.g.
+        `google.appengine.api.memcache`) to use as a shared second tier.
+    '''
+    DEFAULT_TTLS = {
+        'users': 5 * 60,
+        'contacts/nearby': 10 * 60,
+        'balance': 30,
+        'fundingsources': 5 * 60,
+    }
+    namespace = 'dwolla_responses'
+
+    def __init__(self, ttls=None, maxsize=1000, memcache=None):
+        self.ttls = self.DEFAULT_TTLS.copy() if ttls is None else ttls
+        self.local = LRUCache(maxsize)
+        self.memcache = memcache
+        self.counters = collections.defaultdict(int)
+        self._lock = threading.Lock()
+
+    def ttl(self, endpoint):
+        '''returns the ttl for an endpoint, 0 if it isn't cached'''
+        endpoint = endpoint.strip('/')
+        if endpoint in self.ttls:
+            return self.ttls[endpoint]
+        return self.ttls.get(endpoint.split('/')[0], 0)
+
+    def key(self, scope, endpoint, params):
+        raw = json.dumps([scope, endpoint.strip('/'), params], sort_keys=True)
+        return hashlib.sha1(raw).hexdigest()
+
+    def _count(self, name, endpoint):
+        with self._lock:
+            self.counters[name] += 1
+            self.counters['%s:%s' % (name, endpoint.strip('/').split('/')[0])] += 1
+
+    def get(self, scope, endpoint, params):
+        '''
+        returns the cached response, or `MISS`.
+
+        :param scope: string identifying whose response this is (e.g. the
+            client id, or a hash of the user's access token).
+        '''
+        if not self.ttl(endpoint):
+            return MISS
+        key = self.key(scope, endpoint, params)
+        value = self.local.get(key, MISS)
+        if value is not MISS:
+            self._count('hits', endpoint)
+            return copy.deepcopy(value)
+        if self.memcache:
+            value = self.memcache.get(key, namespace=self.namespace)
+            if value is not None:
+                self._count('hits', endpoint)
+                self._count('memcache_hits', endpoint)
+                self.local.set(key, value, self.ttl(endpoint))
+                return copy.deepcopy(value)
+        self._count('misses', endpoint)
+        return MISS
+
+    def set(self, scope, endpoint, params, value):
+        ttl = self.ttl(endpoint)
+        if not ttl:
+            return
+        key = self.key(scope, endpoint, params)
+        self.local.set(key, copy.deepcopy(value), ttl)
+        if self.memcache:
+            self.memcache.set(key, value, time=ttl, namespace=self.namespace)
+
+    def invalidate(self, scope, endpoint, params=None):
+        '''drops the cached response for `endpoint` (called with `params`)'''
+        key = self.key(scope, endpoint, params or {})
+        self.local.delete(key)
+        if self.memcache:
+            self.memcache.delete(key, namespace=self.namespace)
+        self._count('invalidations', endpoint)
+
+    def stats(self):
+        '''
+        returns a dict of counters: `hits`, `misses`, `memcache_hits` and
+        `invalidations`, in total and per endpoint (e.g. `hits:balance`),
+        plus the current number of in-process entries as `size`.
+        '''
+        with self._lock:
+            stats = dict(self.counters)
+        stats['size'] = len(self.local)
+        return stats
+
+    def clear(self):
+        self.local.clear()
+        with self._lock:
+            self.counters.clear()
@@ -0,0 +1,88 @@
+'''
+Shopping carts for dwolla's off-site gateway.
+
+A `Cart` is one order: what to charge, and where the money goes.  It
+holds no connection or credentials, so carts can be built anywhere and
+sent by any `DwollaGateway`, one at a time with `create_checkout` or many
+at once with `create_checkouts`::
+
+    carts = []
+    for invoice in invoices:
+        cart = dwolla.Cart('812-111-1111', order_id=invoice.number)
+        cart.add('Invoice %s' % invoice.number, invoice.amount)
+        carts.append(cart)
+    for order_id, url, error in gateway.create_checkouts(carts):
+        ...
+
+Amounts are `Decimal`s rounded to cents, so totals add up exactly.
+'''
+
+from decimal import Decimal, ROUND_HALF_UP
+
+CENTS = Decimal('0.01')
+
+
+def to_decimal(value):
+    '''converts an amount (number or string) to a `Decimal` in cents'''
+    if not isinstance(value, Decimal):
+        value = Decimal(str(value))
+    return value.quantize(CENTS, rounding=ROUND_HALF_UP)
+
+
+class Cart(object):
+    '''
+    The products of one order, and its destination account.
+
+    :param destination_id: dwolla id of the account to pay.
+
+    :param order_id: (optional) your id for the order, passed back to the
+        callback.
+
+    :param discount, shipping, tax: (optional) amounts for the order.
+
+    :param notes: (optional) notes for the transaction.
+
+    :param callback: (optional) url dwolla posts the payment result to.
+    '''
+    def __init__(self, destination_id, order_id=None, discount=0, shipping=0,
+            tax=0, notes=None, callback=None):
+        self.destination_id = destination_id
+        self.order_id = order_id
+        self.discount = to_decimal(discount)
+        self.shipping = to_decimal(shipping)
+        self.tax = to_decimal(tax)
+        self.notes = notes
+        self.callback = callback
+        self.products = []
+
+    def add(self, name, price, desc='', qty=1):
+        '''adds `qty` of a product, returns the cart'''
+        self.products.append({
+            'Name': name,
+            'Description': desc,
+            'Price': to_decimal(price),
+            'Quantity': int(qty),
+        })
+        return self
+
+    @property
+    def subtotal(self):
+        return sum((p['Price'] * p['Quantity'] for p in self.products), Decimal('0.00'))
+
+    @property
+    def total(self):
+        return to_decimal(self.subtotal - self.discount + self.shipping + self.tax)
+
+    def purchase_order(self):
+        '''returns the `PurchaseOrder` of a gateway request for the cart'''
+        order = {
+            'DestinationId': self.destination_id,
+            'OrderItems': [dict(p, Price=float(p['Price'])) for p in self.products],
+            'Discount': -float(self.discount),
+            'Shipping': float(self.shipping),
+            'Tax': float(self.tax),
+            'Total': float(self.total),
+        }
+        if self.notes:
+            order['Notes'] = self.notes
+        return order
@@ -0,0 +1,33 @@
+'''
+exceptions raised by the dwolla client.
+'''
+
+
+class DwollaAPIError(Exception):
+    '''Raised if the dwolla api returns an error.'''
+    pass
+
+
+class DwollaUnavailableError(DwollaAPIError):
+    '''
+    Raised if dwolla couldn't be reached, or answered with a server error.
+    For a POST it is unknown whether dwolla processed the request.
+    '''
+    def __init__(self, message, status_code=None):
+        DwollaAPIError.__init__(self, message)
+        self.status_code = status_code
+
+
+class RequestNotSentError(DwollaUnavailableError):
+    '''Raised when a request was refused locally, without sending it.'''
+    pass
+
+
+class CircuitOpenError(RequestNotSentError):
+    '''Raised while the circuit breaker is open after too many failures.'''
+    pass
+
+
+class RateLimitError(RequestNotSentError):
+    '''Raised if no rate limiter token became available in time.'''
+    pass
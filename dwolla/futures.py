@@ -0,0 +1,135 @@
+'''
+Minimal futures for issuing dwolla requests concurrently.
+
+Anything with a `get_result()` method counts as a future here, that's the
+interface of App Engine's urlfetch RPC objects, which `UrlfetchTransport`
+hands out directly.  Off App Engine, `Executor` runs blocking calls on a
+small pool of threads and returns a `Future` for each.
+'''
+
+import sys
+import threading
+import Queue
+
+
+class Future(object):
+    '''Result of a call that is running (or ran) on another thread.'''
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+    def get_result(self):
+        '''blocks until the call finished, returns its result or re-raises its error.'''
+        self._done.wait()
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+class MappedFuture(object):
+    '''
+    Wraps a future, and applies `fn` to its result the first time the result
+    is asked for.  Used to parse a response future into the api response.
+    '''
+    def __init__(self, future, fn):
+        self.future = future
+        self.fn = fn
+        self._lock = threading.Lock()
+        self._value = None
+        self._exc_info = None
+        self._mapped = False
+
+    def done(self):
+        return self._mapped or getattr(self.future, 'done', lambda: False)()
+
+    def get_result(self):
+        with self._lock:
+            if not self._mapped:
+                try:
+                    self._value = self.fn(self.future.get_result())
+                except Exception:
+                    self._exc_info = sys.exc_info()
+                self._mapped = True
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._value
+
+
+class Executor(object):
+    '''
+    Runs callables on at most `max_workers` threads.  Worker threads are
+    started on demand and exit as soon as there is nothing left to do, so
+    no thread outlives the work it was started for (App Engine doesn't let
+    threads outlive the request).
+    '''
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._workers = 0
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        self._queue.put((future, fn, args, kwargs))
+        with self._lock:
+            if self._workers < self.max_workers:
+                self._workers += 1
+                t = threading.Thread(target=self._work)
+                t.daemon = True
+                t.start()
+        return future
+
+    def map(self, fn, iterable):
+        '''submits `fn(x)` for each x, returns the list of futures'''
+        return [self.submit(fn, x) for x in iterable]
+
+    def _work(self):
+        while True:
+            with self._lock:
+                try:
+                    future, fn, args, kwargs = self._queue.get_nowait()
+                except Queue.Empty:
+                    self._workers -= 1
+                    return
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception:
+                future.set_exc_info(sys.exc_info())
+
+
+def gather(*futures, **kwargs):
+    '''
+    Waits for all the given futures and returns their results as a list, in
+    the same order.  Since the calls are already in flight, this takes as
+    long as the slowest of them.
+
+    :param return_exceptions: (optional) if True, exceptions are returned
+        in place of the result instead of being raised. Defaults to False,
+        which raises the first error (in argument order).
+    '''
+    return_exceptions = kwargs.get('return_exceptions', False)
+    results = []
+    for future in futures:
+        try:
+            results.append(future.get_result())
+        except Exception as e:
+            if not return_exceptions:
+                raise
+            results.append(e)
+    return results
@@ -0,0 +1,271 @@
+'''
+Compact transaction records.
+
+The api returns transactions as dicts, which take a lot of memory once
+there are thousands of them.  `Transaction` holds the same fields in
+`__slots__`, and `TransactionTable` keeps many transactions column by
+column, with the numbers in `array`s and repeated strings (types,
+statuses, account ids) shared between rows::
+
+    table = api.load_transactions(since=datetime.date(2012, 1, 1))
+    total = sum(table.amounts)
+    for tx in table:
+        print tx.date, tx.amount, tx.destination_id
+
+Dates are kept as the strings the api sent and only parsed when they're
+first used, for a whole column at once in a table.
+'''
+
+import array
+import calendar
+import datetime
+
+DATE_FORMATS = [
+    '%m/%d/%Y %H:%M:%S',
+    '%m/%d/%Y %I:%M:%S %p',
+    '%Y-%m-%dT%H:%M:%SZ',
+    '%Y-%m-%dT%H:%M:%S',
+    '%m-%d-%Y',
+]
+
+
+def parse_date(value, formats=DATE_FORMATS):
+    '''
+    parses a date string as returned by the dwolla api into a
+    `datetime.datetime`. Returns None for empty values.
+    '''
+    if not value:
+        return None
+    if isinstance(value, datetime.datetime):
+        return value
+    for fmt in formats:
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError("unknown date format: %r" % value)
+
+
+class DateParser(object):
+    '''
+    `parse_date` for many dates in the same format: tries the format that
+    worked last time first.
+    '''
+    def __init__(self):
+        self.formats = list(DATE_FORMATS)
+
+    def __call__(self, value):
+        if not value or isinstance(value, datetime.datetime):
+            return value or None
+        try:
+            return datetime.datetime.strptime(value, self.formats[0])
+        except ValueError:
+            pass
+        for fmt in self.formats[1:]:
+            try:
+                date = datetime.datetime.strptime(value, fmt)
+            except ValueError:
+                continue
+            self.formats.remove(fmt)
+            self.formats.insert(0, fmt)
+            return date
+        raise ValueError("unknown date format: %r" % value)
+
+
+def _short(value):
+    '''ascii strings as `str`, so they can be interned'''
+    if value is None:
+        return None
+    try:
+        return intern(str(value))
+    except UnicodeError:
+        return value
+
+
+class Transaction(object):
+    '''
+    One transaction, with typed fields: `id` is an int, `amount` a float,
+    `date` and `clearing_date` are `datetime`s (or None), parsed on first
+    access.
+    '''
+    __slots__ = ('id', 'amount', '_date', 'type', 'user_type', 'status',
+        'source_id', 'source_name', 'destination_id', 'destination_name',
+        '_clearing_date', 'notes')
+
+    def __init__(self, id, amount, date=None, type=None, user_type=None,
+            status=None, source_id=None, source_name=None, destination_id=None,
+            destination_name=None, clearing_date=None, notes=None):
+        self.id = id
+        self.amount = amount
+        self._date = date
+        self.type = type
+        self.user_type = user_type
+        self.status = status
+        self.source_id = source_id
+        self.source_name = source_name
+        self.destination_id = destination_id
+        self.destination_name = destination_name
+        self._clearing_date = clearing_date
+        self.notes = notes
+
+    @classmethod
+    def from_dict(cls, tx):
+        '''makes a record from a transaction dict returned by the api'''
+        return cls(int(tx['Id']),
+            float(tx.get('Amount') or 0),
+            tx.get('Date') or None,
+            _short(tx.get('Type')),
+            _short(tx.get('UserType')),
+            _short(tx.get('Status')),
+            _short(tx.get('SourceId')),
+            tx.get('SourceName'),
+            _short(tx.get('DestinationId')),
+            tx.get('DestinationName'),
+            tx.get('ClearingDate') or None,
+            tx.get('Notes'))
+
+    @property
+    def date(self):
+        if isinstance(self._date, basestring):
+            self._date = parse_date(self._date)
+        return self._date
+
+    @property
+    def clearing_date(self):
+        if isinstance(self._clearing_date, basestring):
+            self._clearing_date = parse_date(self._clearing_date)
+        return self._clearing_date
+
+    def to_dict(self):
+        '''returns the transaction in the api's format'''
+        date, clearing_date = self.date, self.clearing_date
+        return {
+            'Id': self.id,
+            'Amount': self.amount,
+            'Date': date.strftime(DATE_FORMATS[0]) if date else '',
+            'Type': self.type,
+            'UserType': self.user_type,
+            'Status': self.status,
+            'SourceId': self.source_id,
+            'SourceName': self.source_name,
+            'DestinationId': self.destination_id,
+            'DestinationName': self.destination_name,
+            'ClearingDate': clearing_date.strftime(DATE_FORMATS[0]) if clearing_date else '',
+            'Notes': self.notes,
+        }
+
+    def __repr__(self):
+        return '<Transaction %s %s %.2f>' % (self.id, self.type, self.amount)
+
+
+class TransactionTable(object):
+    '''
+    Many transactions, stored by column.  `ids` and `amounts` are arrays,
+    `dates` (and `timestamps`, seconds since the epoch as an array of
+    floats) are parsed for all rows on first access.  Indexing or
+    iterating gives `Transaction` records, made on the fly.
+
+    :param transactions: (optional) iterable of transaction dicts (as
+        returned by the api) or `Transaction` records to add.
+    '''
+    COLUMNS = ('type', 'user_type', 'status', 'source_id', 'source_name',
+        'destination_id', 'destination_name', 'notes')
+
+    def __init__(self, transactions=()):
+        self.ids = array.array('l')
+        self.amounts = array.array('d')
+        self.columns = dict((name, []) for name in self.COLUMNS)
+        self._raw_dates = []
+        self._raw_clearing_dates = []
+        self._dates = None
+        self._clearing_dates = None
+        self._timestamps = None
+        self._strings = {}
+        self.extend(transactions)
+
+    def _share(self, value):
+        if value is None:
+            return None
+        return self._strings.setdefault(value, value)
+
+    def append(self, tx):
+        '''adds a transaction dict or `Transaction` record'''
+        if isinstance(tx, Transaction):
+            tx = tx.to_dict()
+        self.ids.append(int(tx['Id']))
+        self.amounts.append(float(tx.get('Amount') or 0))
+        self._raw_dates.append(tx.get('Date') or None)
+        self._raw_clearing_dates.append(tx.get('ClearingDate') or None)
+        columns = self.columns
+        columns['type'].append(_short(tx.get('Type')))
+        columns['user_type'].append(_short(tx.get('UserType')))
+        columns['status'].append(_short(tx.get('Status')))
+        columns['source_id'].append(_short(tx.get('SourceId')))
+        columns['source_name'].append(self._share(tx.get('SourceName')))
+        columns['destination_id'].append(_short(tx.get('DestinationId')))
+        columns['destination_name'].append(self._share(tx.get('DestinationName')))
+        columns['notes'].append(tx.get('Notes') or None)
+        self._dates = self._clearing_dates = self._timestamps = None
+
+    def extend(self, transactions):
+        for tx in transactions:
+            self.append(tx)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def dates(self):
+        '''list of the transactions' dates'''
+        if self._dates is None:
+            parse = DateParser()
+            self._dates = [parse(d) for d in self._raw_dates]
+        return self._dates
+
+    @property
+    def clearing_dates(self):
+        if self._clearing_dates is None:
+            parse = DateParser()
+            self._clearing_dates = [parse(d) for d in self._raw_clearing_dates]
+        return self._clearing_dates
+
+    @property
+    def timestamps(self):
+        '''array of the dates as seconds since the epoch (0 for no date)'''
+        if self._timestamps is None:
+            self._timestamps = array.array('d', [
+                calendar.timegm(d.timetuple()) if d else 0.0 for d in self.dates])
+        return self._timestamps
+
+    def column(self, name):
+        '''returns a column by field name, e.g. `type` or `amount`'''
+        if name == 'id':
+            return self.ids
+        if name == 'amount':
+            return self.amounts
+        if name == 'date':
+            return self.dates
+        if name == 'clearing_date':
+            return self.clearing_dates
+        return self.columns[name]
+
+    def __getitem__(self, i):
+        columns = self.columns
+        return Transaction(self.ids[i], self.amounts[i],
+            self._dates[i] if self._dates is not None else self._raw_dates[i],
+            columns['type'][i],
+            columns['user_type'][i],
+            columns['status'][i],
+            columns['source_id'][i],
+            columns['source_name'][i],
+            columns['destination_id'][i],
+            columns['destination_name'][i],
+            self._raw_clearing_dates[i],
+            columns['notes'][i])
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def to_dicts(self):
+        return [tx.to_dict() for tx in self]
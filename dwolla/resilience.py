@@ -0,0 +1,252 @@
+'''
+Traffic shaping for requests to dwolla.
+
+`ResilientTransport` wraps another transport and puts every request
+through a shared `TokenBucket` rate limiter and a `CircuitBreaker`, and
+retries failed GET requests with jittered exponential backoff (`Retry`).
+When dwolla throttles us or is down, requests fail fast with a
+`RequestNotSentError` instead of tying up a handler thread each.
+
+The default transport (see `dwolla.get_default_transport`) is wrapped in
+one of these, so all client objects share its limiter and breaker.
+'''
+
+import time
+import random
+import logging
+import threading
+from dwolla.errors import (DwollaUnavailableError, CircuitOpenError,
+    RateLimitError)
+from dwolla.transport import Transport
+
+# status codes worth retrying / counting against the circuit breaker
+RETRY_STATUS = set([429, 500, 502, 503, 504])
+
+
+class TokenBucket(object):
+    '''
+    Token bucket rate limiter, allows `rate` requests per second on average
+    with bursts of up to `burst` requests.  Thread safe.
+    '''
+    def __init__(self, rate=10.0, burst=20):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self):
+        '''takes a token if there is one, returns whether it did'''
+        with self._lock:
+            self._refill(time.time())
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def acquire(self, timeout=1.0):
+        '''
+        waits up to `timeout` seconds for a token. Returns True if it got
+        one, False if none would become available in time.
+        '''
+        with self._lock:
+            now = time.time()
+            self._refill(now)
+            wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0
+            if wait > timeout:
+                return False
+            # reserve the token now, and sleep until it's ours
+            self.tokens -= 1
+        if wait:
+            time.sleep(wait)
+        return True
+
+
+class CircuitBreaker(object):
+    '''
+    Opens after `threshold` failures within `window` seconds, and then
+    refuses all calls for `reset_timeout` seconds.  After that a single
+    trial call is let through (half open), its success closes the circuit
+    again, its failure re-opens it.  A trial whose outcome is never
+    recorded (e.g. an async request nobody collected) is given up on after
+    another `reset_timeout` seconds, and a new one is let through.
+    '''
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, threshold=5, window=30, reset_timeout=30):
+        self.threshold = threshold
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = []
+        self.opened_at = 0
+        self.trial_at = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        '''returns whether a call may go through right now'''
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.time()
+            if self.state == self.OPEN and now - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.trial_at = now
+                return True
+            if self.state == self.HALF_OPEN and now - self.trial_at >= self.reset_timeout:
+                self.trial_at = now
+                return True
+            return False
+
+    def release(self):
+        '''
+        gives back the trial handed out by `allow` to a call that was not
+        made after all, so the next call can be the trial instead
+        '''
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+                self.opened_at = time.time() - self.reset_timeout
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logging.info("dwolla circuit breaker closed")
+            self.state = self.CLOSED
+            self.failures = []
+
+    def record_failure(self):
+        with self._lock:
+            now = time.time()
+            self.failures = [t for t in self.failures if now - t < self.window]
+            self.failures.append(now)
+            if self.state == self.HALF_OPEN or len(self.failures) >= self.threshold:
+                if self.state != self.OPEN:
+                    logging.warning("dwolla circuit breaker opened")
+                self.state = self.OPEN
+                self.opened_at = now
+
+
+class Retry(object):
+    '''
+    Retry policy: up to `attempts` tries in total, sleeping a random time
+    between 0 and `min(cap, base * 2**n)` seconds before try n+1 ("full
+    jitter"), so retrying clients don't all come back at the same moment.
+    '''
+    def __init__(self, attempts=3, base=0.1, cap=2.0):
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+
+class ResilientTransport(Transport):
+    '''
+    Wraps a transport with rate limiting, a circuit breaker, and retries
+    for idempotent (GET) requests.
+
+    :param transport: the transport actually sending the requests.
+
+    :param limiter: (optional) `TokenBucket`, or None to not rate limit.
+
+    :param breaker: (optional) `CircuitBreaker`, or None to not use one.
+
+    :param retry: (optional) `Retry` policy for GET requests, or None to
+        never retry.
+
+    :param max_wait: (optional) seconds to wait for a rate limiter token
+        before giving up with a `RateLimitError`. Defaults to 1.
+    '''
+    def __init__(self, transport, limiter=None, breaker=None, retry=None, max_wait=1.0):
+        self.transport = transport
+        self.limiter = limiter
+        self.breaker = breaker
+        self.retry = retry
+        self.max_wait = max_wait
+
+    def _before(self):
+        # check the breaker first, so an open circuit fails fast without
+        # waiting for (or using up) a rate limiter token
+        if self.breaker and not self.breaker.allow():
+            raise CircuitOpenError("dwolla circuit breaker is open")
+        if self.limiter and not self.limiter.acquire(self.max_wait):
+            if self.breaker:
+                # a half open breaker's trial must go to a request that is sent
+                self.breaker.release()
+            raise RateLimitError("dwolla request rate limit exceeded")
+
+    def _check(self, resp):
+        '''raises for responses that count as a failure'''
+        if resp.status_code in RETRY_STATUS:
+            raise DwollaUnavailableError("dwolla returned HTTP %d" % resp.status_code,
+                status_code=resp.status_code)
+        return resp
+
+    def _failed(self, e):
+        if self.breaker:
+            self.breaker.record_failure()
+        if isinstance(e, DwollaUnavailableError):
+            return e
+        return DwollaUnavailableError("%s: %s" % (e.__class__.__name__, e))
+
+    def _succeeded(self, resp):
+        if self.breaker:
+            self.breaker.record_success()
+        return resp
+
+    def fetch(self, url, method='GET', payload=None, headers=None, deadline=None):
+        attempts = self.retry.attempts if (self.retry and method == 'GET') else 1
+        for attempt in range(attempts):
+            if attempt:
+                time.sleep(self.retry.backoff(attempt))
+            self._before()
+            try:
+                resp = self._check(self.transport.fetch(url, method, payload, headers, deadline))
+            except Exception as e:
+                error = self._failed(e)
+                continue
+            return self._succeeded(resp)
+        raise error
+
+    def fetch_async(self, url, method='GET', payload=None, headers=None, deadline=None):
+        self._before()
+        try:
+            rpc = self.transport.fetch_async(url, method, payload, headers, deadline)
+        except Exception as e:
+            raise self._failed(e)
+        return _CheckedRPC(self, rpc, (url, method, payload, headers, deadline))
+
+
+class _CheckedRPC(object):
+    '''
+    Future for a request sent through `ResilientTransport.fetch_async`,
+    applies the breaker and retry policy when its result is fetched.
+    '''
+    def __init__(self, transport, rpc, args):
+        self.transport = transport
+        self.rpc = rpc
+        self.args = args
+
+    def done(self):
+        return getattr(self.rpc, 'done', lambda: False)()
+
+    def get_result(self):
+        t = self.transport
+        try:
+            return t._succeeded(t._check(self.rpc.get_result()))
+        except Exception as e:
+            error = t._failed(e)
+        url, method = self.args[0], self.args[1]
+        if not (t.retry and method == 'GET' and t.retry.attempts > 1):
+            raise error
+        # first try was the async one, do any retries synchronously
+        retry = Retry(t.retry.attempts - 1, t.retry.base, t.retry.cap)
+        time.sleep(t.retry.backoff(1))
+        return ResilientTransport(t.transport, t.limiter, t.breaker, retry,
+            t.max_wait).fetch(*self.args)
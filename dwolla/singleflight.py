@@ -0,0 +1,83 @@
+'''
+Single-flight request coalescing.
+
+When several threads ask for the same thing at the same time, only the
+first one (the leader) actually does the work, the others wait for it and
+get the same result, or the same error.  `DwollaClientApp.get` and
+`DwollaUser.get` run their requests through a shared `SingleFlight` group,
+keyed by (account, endpoint, params).
+'''
+
+import sys
+import copy
+import json
+import threading
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    '''A group of in-flight calls, keyed by string. Thread safe.'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        '''
+        Calls `fn()` and returns its result, unless a call with the same key
+        is already in flight, in which case this waits for that one and
+        returns (a copy of) its result, or raises its error.
+        '''
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.coalesced += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.exc_info:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            # each caller gets its own copy to mutate
+            return copy.deepcopy(call.result)
+
+        result = None
+        try:
+            result = fn()
+            return result
+        except:
+            # not only Exception: a DeadlineExceededError must not reach
+            # the waiters as a None result
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            # no new waiters from here on.  give them a private copy, the
+            # leader's caller is free to mutate the one it gets back.
+            if call.waiters and not call.exc_info:
+                call.result = copy.deepcopy(result)
+            call.done.set()
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+
+def flight_key(scope, endpoint, params):
+    return json.dumps([scope, endpoint.strip('/'), params], sort_keys=True)
+
+
+# shared by all client objects on this instance
+default_group = SingleFlight()
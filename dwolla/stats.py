@@ -0,0 +1,222 @@
+'''
+Per-endpoint request statistics.
+
+The client classes record every request they send in a `Stats` object
+(their `stats` attribute, `default_stats` unless set otherwise): its
+latency in a histogram, the request and response sizes, errors counted by
+class, and for cached endpoints the cache hits and misses.  The numbers
+are kept in process, call `snapshot()` to get them, e.g. to store them
+somewhere shared like memcache and `merge` them with other instances'::
+
+    for name, entry in dwolla.stats.default_stats.snapshot().items():
+        print name, entry['count'], dwolla.stats.percentile(entry, 95)
+
+Endpoints are named by their path with ids replaced, e.g. `users/:id`.
+'''
+
+import re
+import time
+import copy
+import threading
+from dwolla.errors import DwollaAPIError
+
+# latency histogram bucket upper bounds, in milliseconds
+BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_ID_RE = re.compile(r'[\d@]')
+_NUMBER_RE = re.compile(r'\d+')
+
+
+def endpoint_name(path):
+    '''names an endpoint by its path, with id segments replaced by :id'''
+    segments = [s for s in path.split('?')[0].split('/') if s]
+    return '/'.join(':id' if _ID_RE.search(s) else s for s in segments)
+
+
+def error_class(e):
+    '''
+    names the class of an error for counting.  Plain `DwollaAPIError`s are
+    told apart by their message, up to any details after a colon and with
+    numbers replaced, e.g. "Insufficient funds.".  Other errors go by
+    their exception class.
+    '''
+    if type(e) is DwollaAPIError:
+        message = unicode(e).split(':')[0].strip()
+        return _NUMBER_RE.sub('#', message)[:80] or 'DwollaAPIError'
+    status = getattr(e, 'status_code', None)
+    if status:
+        return '%s %d' % (e.__class__.__name__, status)
+    return e.__class__.__name__
+
+
+def new_entry():
+    return {
+        'count': 0,
+        'errors': 0,
+        'seconds': 0.0,
+        'max': 0.0,
+        'sent': 0,
+        'received': 0,
+        'buckets': [0] * (len(BUCKETS) + 1),
+        'error_classes': {},
+        'cache_hits': 0,
+        'cache_misses': 0,
+    }
+
+
+def merge(snapshots):
+    '''adds up a list of snapshots (e.g. from several instances)'''
+    merged = {}
+    for snapshot in snapshots:
+        for name, entry in snapshot.items():
+            total = merged.setdefault(name, new_entry())
+            for key in ('count', 'errors', 'seconds', 'sent', 'received',
+                    'cache_hits', 'cache_misses'):
+                total[key] += entry.get(key, 0)
+            total['max'] = max(total['max'], entry.get('max', 0))
+            for i, n in enumerate(entry.get('buckets', [])):
+                total['buckets'][i] += n
+            for cls, n in entry.get('error_classes', {}).items():
+                total['error_classes'][cls] = total['error_classes'].get(cls, 0) + n
+    return merged
+
+
+def percentile(entry, p):
+    '''
+    estimates the `p`th percentile latency of an entry in milliseconds,
+    from its histogram (so it's the upper bound of a bucket).
+    '''
+    buckets = entry['buckets']
+    total = sum(buckets)
+    if not total:
+        return 0.0
+    rank = p / 100.0 * total
+    seen = 0
+    for bound, n in zip(BUCKETS, buckets):
+        seen += n
+        if seen >= rank:
+            return float(bound)
+    return entry['max'] * 1000
+
+
+class Stats(object):
+    '''
+    Thread safe, in-process request statistics, by endpoint name.
+    '''
+    def __init__(self):
+        self.entries = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def _entry(self, name):
+        entry = self.entries.get(name)
+        if entry is None:
+            entry = self.entries[name] = new_entry()
+        return entry
+
+    def record(self, name, seconds, sent=0, received=0, status=None, error=None):
+        '''
+        records a request to endpoint `name` that took `seconds`.  Responses
+        with an HTTP error `status` and requests that raised `error` count
+        as errors.
+        '''
+        ms = seconds * 1000
+        bucket = len(BUCKETS)
+        for i, bound in enumerate(BUCKETS):
+            if ms <= bound:
+                bucket = i
+                break
+        if error is None and status and status >= 400:
+            cls = 'HTTP %d' % status
+        elif error is not None:
+            cls = error_class(error)
+        else:
+            cls = None
+        with self._lock:
+            entry = self._entry(name)
+            entry['count'] += 1
+            entry['seconds'] += seconds
+            entry['max'] = max(entry['max'], seconds)
+            entry['sent'] += sent
+            entry['received'] += received
+            entry['buckets'][bucket] += 1
+            if cls:
+                entry['errors'] += 1
+                entry['error_classes'][cls] = entry['error_classes'].get(cls, 0) + 1
+
+    def record_error(self, name, error):
+        '''records an error response to a request that was already recorded'''
+        cls = error_class(error)
+        with self._lock:
+            entry = self._entry(name)
+            entry['errors'] += 1
+            entry['error_classes'][cls] = entry['error_classes'].get(cls, 0) + 1
+
+    def record_cache(self, name, hit):
+        with self._lock:
+            self._entry(name)['cache_hits' if hit else 'cache_misses'] += 1
+
+    def fetch(self, transport, name, url, method='GET', payload=None, headers=None):
+        '''sends a request through `transport`, recording it as `name`'''
+        start = time.time()
+        try:
+            resp = transport.fetch(url, method=method, payload=payload, headers=headers)
+        except Exception as e:
+            self.record(name, time.time() - start, len(payload or ''), error=e)
+            raise
+        self.record(name, time.time() - start, len(payload or ''),
+            len(resp.content or ''), resp.status_code)
+        return resp
+
+    def fetch_async(self, transport, name, url, method='GET', payload=None, headers=None):
+        '''
+        like `fetch`, but with `transport.fetch_async`.  The request is
+        timed until its result is first asked for.
+        '''
+        rpc = transport.fetch_async(url, method=method, payload=payload, headers=headers)
+        return _RecordedRPC(self, rpc, name, time.time(), len(payload or ''))
+
+    def snapshot(self):
+        '''returns a copy of the statistics, a dict of entries by endpoint'''
+        with self._lock:
+            return copy.deepcopy(self.entries)
+
+    def clear(self):
+        with self._lock:
+            self.entries = {}
+            self.started = time.time()
+
+
+class _RecordedRPC(object):
+    '''future for `Stats.fetch_async`, records the request once it's done'''
+    def __init__(self, stats, rpc, name, start, sent):
+        self.stats = stats
+        self.rpc = rpc
+        self.name = name
+        self.start = start
+        self.sent = sent
+        self._recorded = False
+        self._lock = threading.Lock()
+
+    def done(self):
+        return getattr(self.rpc, 'done', lambda: False)()
+
+    def get_result(self):
+        try:
+            resp = self.rpc.get_result()
+        except Exception as e:
+            self._record(error=e)
+            raise
+        self._record(received=len(resp.content or ''), status=resp.status_code)
+        return resp
+
+    def _record(self, **kwargs):
+        with self._lock:
+            if self._recorded:
+                return
+            self._recorded = True
+        self.stats.record(self.name, time.time() - self.start, self.sent, **kwargs)
+
+
+# shared by all client objects, unless they're given another one
+default_stats = Stats()
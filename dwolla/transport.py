@@ -0,0 +1,372 @@
+'''
+HTTP transports used by the dwolla client classes.
+
+Every request the client makes goes through a transport's `fetch` method,
+which takes the same arguments as App Engine's `urlfetch.fetch` and returns
+an object with `status_code`, `content` and `headers` attributes.
+`fetch_async` does the same, but returns a future right away (see
+`dwolla.futures`).  Pass an
+instance as the `transport` argument of `DwollaGateway`, `DwollaClientApp`
+or `DwollaUser` to pick one, otherwise `get_default_transport()` is used.
+
+ - `UrlfetchTransport` uses `google.appengine.api.urlfetch` (the default
+   when running on App Engine).
+ - `PooledTransport` keeps alive and reuses `httplib` connections per host,
+   for running outside of App Engine.
+ - `FakeDwollaTransport` is an in-memory stand-in for the dwolla API, for
+   running and load testing the client offline.
+'''
+
+import json
+import time
+import uuid
+import random
+import socket
+import httplib
+import urlparse
+import datetime
+import threading
+import Queue
+from dwolla.futures import Executor
+
+
+class Response(object):
+    '''Minimal response object, mirrors what `urlfetch.fetch` returns.'''
+    def __init__(self, status_code, content, headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+
+class Transport(object):
+    '''
+    Base class for transports.  Subclasses implement `fetch`.
+    '''
+    # executor `fetch_async` runs blocking fetches on, None for the shared one
+    executor = None
+
+    def fetch(self, url, method='GET', payload=None, headers=None, deadline=None):
+        raise NotImplementedError()
+
+    def fetch_async(self, url, method='GET', payload=None, headers=None, deadline=None):
+        executor = self.executor or _executor
+        return executor.submit(self.fetch, url, method, payload, headers, deadline)
+
+    def close(self):
+        pass
+
+
+class UrlfetchTransport(Transport):
+    '''Sends requests using App Engine's urlfetch service.'''
+    def __init__(self, deadline=None):
+        from google.appengine.api import urlfetch
+        self.urlfetch = urlfetch
+        self.deadline = deadline
+
+    def fetch(self, url, method='GET', payload=None, headers=None, deadline=None):
+        return self.urlfetch.fetch(url,
+            method=getattr(self.urlfetch, method),
+            payload=payload,
+            headers=headers or {},
+            deadline=deadline or self.deadline,
+            validate_certificate=True
+        )
+
+    def fetch_async(self, url, method='GET', payload=None, headers=None, deadline=None):
+        # urlfetch rpc's run concurrently without needing any threads
+        rpc = self.urlfetch.create_rpc(deadline=deadline or self.deadline)
+        self.urlfetch.make_fetch_call(rpc, url,
+            method=getattr(self.urlfetch, method),
+            payload=payload,
+            headers=headers or {},
+            validate_certificate=True
+        )
+        return rpc
+
+
+class PooledTransport(Transport):
+    '''
+    Keep-alive transport built on `httplib`.  Idle connections are kept in a
+    per host pool (at most `maxsize` each) and reused by later requests, so
+    we only pay for the TCP/TLS handshake once per connection instead of
+    once per request.  Safe to share between threads.
+    '''
+    def __init__(self, maxsize=10, timeout=30):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def _pool(self, key):
+        with self._lock:
+            if key not in self._pools:
+                self._pools[key] = Queue.LifoQueue(self.maxsize)
+            return self._pools[key]
+
+    def _connect(self, scheme, host, port, timeout):
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, port, timeout=timeout)
+        return httplib.HTTPConnection(host, port, timeout=timeout)
+
+    def fetch(self, url, method='GET', payload=None, headers=None, deadline=None):
+        o = urlparse.urlsplit(url)
+        key = (o.scheme, o.hostname, o.port)
+        path = o.path or '/'
+        if o.query:
+            path = "%s?%s" % (path, o.query)
+        headers = dict(headers or {})
+        headers.setdefault('Connection', 'keep-alive')
+
+        pool = self._pool(key)
+        try:
+            conn, reused = pool.get_nowait(), True
+        except Queue.Empty:
+            conn, reused = None, False
+
+        while True:
+            if conn is None:
+                conn = self._connect(o.scheme, o.hostname, o.port, deadline or self.timeout)
+            sent = False
+            try:
+                conn.request(method, path, payload, headers)
+                sent = True
+                resp = conn.getresponse()
+                content = resp.read()
+                break
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                conn = None
+                # the server may have dropped an idle connection on us,
+                # retry once on a fresh one.  Once the request went out
+                # dwolla may have processed it, so then only GETs are
+                # retried, and never after a timeout.
+                if not reused:
+                    raise
+                if sent and (method != 'GET' or isinstance(e, socket.timeout)):
+                    raise
+                reused = False
+
+        if resp.will_close:
+            conn.close()
+        else:
+            try:
+                pool.put_nowait(conn)
+            except Queue.Full:
+                conn.close()
+        return Response(resp.status, content, dict(resp.getheaders()))
+
+    def close(self):
+        with self._lock:
+            pools, self._pools = self._pools.values(), {}
+        for pool in pools:
+            while True:
+                try:
+                    pool.get_nowait().close()
+                except Queue.Empty:
+                    break
+
+
+class FakeDwollaTransport(Transport):
+    '''
+    In-memory fake of the dwolla REST, OAuth and off-site gateway API's.
+    Keeps a single account with a balance, contacts, funding sources and a
+    transaction history, and answers requests the way dwolla would.
+
+    :param latency: seconds to sleep for each request, or a `(min, max)`
+        tuple to pick a random latency from.
+
+    :param error_rate: fraction (0-1) of requests that fail with a
+        `503` response.
+    '''
+    def __init__(self, latency=0, error_rate=0, balance=100.0, account_id='812-111-1111'):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.account = {
+            'Id': account_id,
+            'Name': 'Fake Account',
+            'City': 'Des Moines',
+            'State': 'IA',
+            'Latitude': 41.59,
+            'Longitude': -93.62,
+            'Type': 'Personal',
+        }
+        self.balance = balance
+        self.contacts = [
+            {'Id': '812-222-2222', 'Name': 'Contact One', 'Type': 'Dwolla',
+             'Image': '', 'City': 'Des Moines', 'State': 'IA'},
+        ]
+        self.funding_sources = [
+            {'Id': 'fs1', 'Name': 'Checking - 1234', 'Type': 'Checking',
+             'Verified': 'true', 'ProcessingType': 'ACH'},
+        ]
+        self.transactions = []
+        self.checkouts = {}
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._next_id = 1000
+
+    def fetch(self, url, method='GET', payload=None, headers=None, deadline=None):
+        with self._lock:
+            self.requests += 1
+        latency = self.latency
+        if isinstance(latency, tuple):
+            latency = random.uniform(*latency)
+        if latency:
+            time.sleep(latency)
+        if self.error_rate and random.random() < self.error_rate:
+            return Response(503, 'Service Unavailable')
+
+        o = urlparse.urlsplit(url)
+        path = '/'.join(p for p in o.path.split('/') if p)
+        params = dict(urlparse.parse_qsl(o.query))
+        if payload:
+            params.update(json.loads(payload))
+
+        with self._lock:
+            if path == 'payment/request':
+                return self._json(self._payment_request(params))
+            if path == 'oauth/v2/token':
+                return self._json(self._token(params))
+            if path.startswith('oauth/rest/'):
+                return self._json(self._rest(method, path[len('oauth/rest/'):], params))
+        return Response(404, 'Not Found')
+
+    def _json(self, data):
+        return Response(200, json.dumps(data), {'Content-Type': 'application/json'})
+
+    def _ok(self, response):
+        return {'Success': True, 'Message': 'Success', 'Response': response}
+
+    def _error(self, message):
+        return {'Success': False, 'Message': message, 'Response': None}
+
+    def _payment_request(self, req):
+        order = req.get('PurchaseOrder') or {}
+        if not order.get('DestinationId'):
+            return {'Result': 'Failure', 'Message': 'Invalid destination'}
+        checkout_id = str(uuid.uuid4())
+        self.checkouts[checkout_id] = req
+        return {'Result': 'Success', 'CheckoutId': checkout_id}
+
+    def _token(self, params):
+        if not params.get('code'):
+            return {'error': 'invalid_request', 'error_description': 'missing code'}
+        return {'access_token': 'fake-token-%s' % params['code']}
+
+    def _add_transaction(self, amount, type, dest, source, notes=''):
+        self._next_id += 1
+        tx = {
+            'Id': self._next_id,
+            'Amount': amount,
+            'Date': datetime.datetime.utcnow().strftime('%m/%d/%Y %H:%M:%S'),
+            'Type': type,
+            'UserType': 'Dwolla',
+            'DestinationId': dest,
+            'DestinationName': '',
+            'SourceId': source,
+            'SourceName': '',
+            'ClearingDate': '',
+            'Status': 'processed',
+            'Notes': notes or '',
+        }
+        self.transactions.insert(0, tx)
+        return tx
+
+    def _rest(self, method, path, params):
+        if method == 'POST' and path == 'register':
+            return self._ok(dict(self.account, Id='812-%03d-%04d' % (
+                random.randint(0, 999), random.randint(0, 9999))))
+        if path == 'users':
+            return self._ok(self.account)
+        if path.startswith('users/'):
+            return self._ok(dict(self.account, Id=path[len('users/'):]))
+        if path == 'balance':
+            return self._ok(self.balance)
+        if path == 'contacts' or path == 'contacts/nearby':
+            limit = int(params.get('limit', 10))
+            return self._ok(self.contacts[:limit])
+        if path == 'fundingsources':
+            return self._ok(self.funding_sources)
+        if path.startswith('fundingsources/'):
+            for source in self.funding_sources:
+                if source['Id'] == path[len('fundingsources/'):]:
+                    return self._ok(source)
+            return self._error('Invalid funding source provided.')
+        if path == 'transactions/send' and method == 'POST':
+            amount = float(params['amount'])
+            if amount > self.balance:
+                return self._error('Insufficient funds.')
+            self.balance -= amount
+            tx = self._add_transaction(amount, 'money_sent',
+                params['destinationId'], self.account['Id'], params.get('notes'))
+            return self._ok(tx['Id'])
+        if path == 'transactions/request' and method == 'POST':
+            tx = self._add_transaction(float(params['amount']), 'request',
+                self.account['Id'], params['sourceId'], params.get('notes'))
+            return self._ok(tx['Id'])
+        if path == 'transactions/stats':
+            txs = self._filter_transactions(params.get('types'),
+                params.get('startDate'), params.get('endDate'))
+            return self._ok({
+                'TransactionsCount': len(txs),
+                'TransactionsTotal': round(sum(tx['Amount'] for tx in txs), 2),
+            })
+        if path == 'transactions':
+            txs = self._filter_transactions(params.get('types'), params.get('sinceDate'))
+            skip = int(params.get('skip', 0))
+            limit = min(int(params.get('limit', 10)), 200)
+            return self._ok(txs[skip:skip + limit])
+        if path.startswith('transactions/'):
+            tx_id = int(path[len('transactions/'):])
+            for tx in self.transactions:
+                if tx['Id'] == tx_id:
+                    return self._ok(tx)
+            return self._error('Transaction not found for account')
+        return self._error('Invalid resource: %s' % path)
+
+    def _filter_transactions(self, types=None, start=None, end=None):
+        parse = lambda d: datetime.datetime.strptime(d, '%m-%d-%Y')
+        txs = self.transactions
+        if types:
+            types = types.split('|')
+            txs = [tx for tx in txs if tx['Type'] in types]
+        if start:
+            start = parse(start)
+            txs = [tx for tx in txs if self._date(tx) >= start]
+        if end:
+            end = parse(end) + datetime.timedelta(days=1)
+            txs = [tx for tx in txs if self._date(tx) < end]
+        return txs
+
+    def _date(self, tx):
+        return datetime.datetime.strptime(tx['Date'], '%m/%d/%Y %H:%M:%S')
+
+
+_executor = Executor(max_workers=8)
+_default_transport = None
+
+def get_default_transport():
+    '''
+    Returns the transport used by client objects that were not given one.
+    `UrlfetchTransport` on App Engine, `PooledTransport` everywhere else,
+    wrapped in a `ResilientTransport` with the default rate limit, circuit
+    breaker and retry settings.
+    '''
+    global _default_transport
+    if _default_transport is None:
+        from dwolla.resilience import ResilientTransport, TokenBucket, \
+            CircuitBreaker, Retry
+        try:
+            transport = UrlfetchTransport()
+        except ImportError:
+            transport = PooledTransport()
+        _default_transport = ResilientTransport(transport,
+            limiter=TokenBucket(),
+            breaker=CircuitBreaker(),
+            retry=Retry())
+    return _default_transport
+
+def set_default_transport(transport):
+    '''Sets the transport used by client objects that were not given one.'''
+    global _default_transport
+    _default_transport = transport
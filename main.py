@@ -1,20 +1,40 @@
+import boot
+import os
+import time
 import dwolla
+import cache
+import models
+import mardown
+import stats
+import payments
+import hashlib
 import urlparse
 import json
 import webapp2
 from webapp2_extras import sessions
 from webapp2_extras import jinja2
 from google.appengine.ext import db
+from google.appengine.ext import deferred
 from webapp2 import RequestHandler, WSGIApplication
+boot.mark('imports')
 
 
 class BaseHandler(RequestHandler):
     def dispatch(self):
-        self.session_store = sessions.get_store(request=self.request)
+        start = time.time()
+        error = None
         try:
             RequestHandler.dispatch(self)
+        except Exception as e:
+            error = e
+            raise
         finally:
-            self.session_store.save_sessions(self.response)
+            # the store is created on first use of self.session, handlers
+            # that never touch the session have nothing to save.
+            if 'session_store' in self.__dict__:
+                self.session_store.save_sessions(self.response)
+            stats.record_handler(self, time.time() - start, error)
+            stats.maybe_flush()
 
     def base_url(self, secure=False):
         o = urlparse.urlsplit(self.request.url)
@@ -33,20 +53,32 @@ class BaseHandler(RequestHandler):
     def jinja2(self):
         return jinja2.get_jinja2(app=self.app)
 
+    @webapp2.cached_property
+    def session_store(self):
+        return sessions.get_store(request=self.request)
+
     @webapp2.cached_property
     def session(self):
-        return self.session_store.get_session()
+        # session data lives in the datastore (cached in memcache), the
+        # cookie only holds the session id.  It's only written back if it
+        # was modified.
+        return self.session_store.get_session(backend='datastore')
 
     @webapp2.cached_property
     def dwolla(self):
         apikey = self.app.config['DWOLLA_API_KEY']
         secret = self.app.config['DWOLLA_API_SECRET']
-        return dwolla.DwollaClientApp(apikey, secret)
+        return dwolla.DwollaClientApp(apikey, secret, transport=self.dwolla_transport)
+
+    @property
+    def dwolla_transport(self):
+        # None means dwolla's default transport, benchmarks and local runs
+        # can swap in another one via the app registry.
+        return self.app.registry.get('dwolla.transport')
 
 
 class UserHandler(BaseHandler):
     def dispatch(self):
-        self.session_store = sessions.get_store(request=self.request)
         if not self.session.get('user'):
             self.redirect(self.app_url('/login'))
         self.user = db.get( db.Key(session['user']) )
@@ -69,7 +101,7 @@ class DwollaOauthHandler(BaseHandler):
         redirect_uri = self.app_url('/oauth_cb')
         token = self.dwolla.get_oauth_token(code, redirect_uri=redirect_uri)
 
-        api = dwolla.DwollaUser(token)
+        api = dwolla.DwollaUser(token, transport=self.dwolla_transport)
         account = api.get_account_info()
         self.session['user'] = account
         self.session['account'] = str(account['Id'])
@@ -77,26 +109,50 @@ class DwollaOauthHandler(BaseHandler):
 
 
 class MainHandler(BaseHandler):
-    def get(self):
-        item_key = self.request.get('k')
-        try:
-            item = db.get(db.Key(item_key))
-        except:
+    def get(self, slug=None):
+        if slug:
+            item = models.Item.get_by_slug(slug)
+        else:
+            item = models.Item.get_cached(self.request.get('k'))
+        if item is None:
             return self.redirect(self.app_url("/new"))
 
-        apikey = self.app.config['DWOLLA_API_KEY']
-        secret = self.app.config['DWOLLA_API_SECRET']
-        gateway = dwolla.DwollaGateway(apikey, secret, self.app_url('/gateway'))
-        gateway.start_gateway_session()
-        gateway.add_gateway_product(item.account, item.amount, desc=item.text, qty = 1)
+        def create_checkout():
+            apikey = self.app.config['DWOLLA_API_KEY']
+            secret = self.app.config['DWOLLA_API_SECRET']
+            gateway = dwolla.DwollaGateway(apikey, secret, self.app_url('/gateway'),
+                transport=self.dwolla_transport)
+            cart = dwolla.Cart(item.account, order_id=item.url_key(),
+                callback=self.app_url('/confirm'))
+            cart.add(item.account, item.amount, desc=item.text)
+            return gateway.create_checkout(cart)
+
         try:
-            url = gateway.get_gateway_URL(item.account, callback=self.app_url('/confirm'))
-            self.render_template('show.html', url=url, item=item)
+            url = checkout_urls.get(item.url_key(), item.amount, item.text, create_checkout)
         except Exception as e:
             self.session['account'] = item.account
-            self.session['amount'] = item.amount
+            self.session['amount'] = str(item.amount)
             self.session['text'] = item.text
-            self.redirect('/new?err='+str(e))
+            return self.redirect('/new?err='+str(e))
+
+        # the page only changes with the item or its checkout url, so
+        # browsers and the edge cache can revalidate it by etag.  max-age
+        # is kept well below how long a checkout url stays valid.
+        # (and with the deployed version, for template and asset changes)
+        etag = hashlib.sha1('%s|%s|%s|%s' % (item.url_key(), item.version, url,
+            os.environ.get('CURRENT_VERSION_ID'))).hexdigest()
+        self.response.etag = etag
+        self.response.cache_control.public = True
+        self.response.cache_control.max_age = self.app.config.get('PAGE_MAX_AGE', 60)
+        if etag in self.request.if_none_match:
+            self.response.status = 304
+            return
+
+        html = show_pages.get(etag)
+        if html is None:
+            html = self.jinja2.render_template('show.html', url=url, item=item)
+            show_pages.set(etag, html)
+        self.response.write(html)
 
 
 class LogoutHandler(BaseHandler):
@@ -119,28 +175,40 @@ class NewHandler(BaseHandler):
         self.render_template('new.html', account=account, error=err, session=self.session)
 
     def post(self):
-        item = db.Expando()
-        item.account = self.request.get('dwolla_id')
-        item.text = self.request.get('text')
+        account = self.request.get('dwolla_id')
+        text = self.request.get('text')
         try:
-            amount = float(self.request.get('amount').replace("$", ""))
-            item.amount = amount
-            item.put()
-            self.redirect('/?k=%s' % item.key())
-        except:
-            amount = "1.0"
-            item.amount = amount
-            item.put()
-            self.session['account'] = item.account
+            item = models.Item.create(account, self.request.get('amount'), text)
+        except (ValueError, db.BadValueError) as e:
+            self.session['account'] = account
             self.session['amount'] = "0"
-            self.session['text'] = item.text
-            self.redirect('/new?err=Invalid%20Amount.')
+            self.session['text'] = text
+            err = 'Invalid%20Amount.' if isinstance(e, ValueError) else 'Invalid%20Account.'
+            return self.redirect('/new?err=' + err)
+        item.put()
+        self.redirect(item.url_path())
 
 
 class ConfirmHandler(BaseHandler):
     def get(self):
         self.render_template('confirm.html')
 
+    def post(self):
+        # dwolla's payment callback.  Only verified and queued here, the
+        # payment is saved later by /_tasks/payments.
+        try:
+            notification = payments.parse(self.request.body)
+        except ValueError:
+            return self.abort(400)
+        apikey = self.app.config['DWOLLA_API_KEY']
+        secret = self.app.config['DWOLLA_API_SECRET']
+        gateway = dwolla.DwollaGateway(apikey, secret, self.app_url('/gateway'),
+            transport=self.dwolla_transport)
+        if not payments.verify(gateway, notification):
+            return self.abort(403)
+        payments.enqueue(self.request.body)
+        self.response.write('ok')
+
 
 class GatewayHandler(BaseHandler):
     def get(self):
@@ -154,7 +222,63 @@ class PaidHandler(BaseHandler):
         self.render_template(self.request)
 
 
+class RerenderHandler(BaseHandler):
+    '''
+    /_admin/rerender, starts re-rendering item descriptions after a change
+    to the markdown renderer (see `models.rerender_items`).
+    '''
+    def get(self):
+        deferred.defer(models.rerender_items)
+        self.response.write('re-rendering items with renderer version %d' %
+            mardown.RENDERER_VERSION)
+
+
+class PaymentsTaskHandler(BaseHandler):
+    '''/_tasks/payments, run by cron to save queued payment notifications'''
+    def get(self):
+        handled = payments.process()
+        self.response.write('%d notifications' % handled)
+
+
+class StatsHandler(BaseHandler):
+    '''
+    /_stats (admin only), per handler and per dwolla endpoint timings and
+    errors of all instances of this version, and their startup timings.
+    '''
+    def get(self):
+        data = stats.load()
+        self.render_template('stats.html',
+            version=stats.version(),
+            stats=data,
+            handlers=stats.table(data['handlers']),
+            dwolla=stats.table(data['dwolla']),
+            now=time.time())
+
+
+class WarmupHandler(BaseHandler):
+    '''
+    /_ah/warmup, called by app engine before sending traffic to a new
+    instance.  Everything main imports is already imported by now, this
+    primes the rest so the first real request doesn't pay for it.
+    '''
+    def get(self):
+        with boot.phase('templates'):
+            template_path = self.jinja2.config['template_path']
+            for name in os.listdir(template_path):
+                if name.endswith('.html'):
+                    self.jinja2.environment.get_template(name)
+        with boot.phase('dwolla'):
+            dwolla.get_default_transport()
+            self.dwolla
+        boot.log()
+        self.response.write('ok')
+
+
 import config
+boot.mark('config')
+
+checkout_urls = cache.CheckoutURLCache()
+show_pages = cache.PageCache()
 
 app_routes = [
     ('/', MainHandler),
@@ -164,9 +288,18 @@ app_routes = [
     ('/new', NewHandler),
     ('/confirm', ConfirmHandler),
     ('/gateway', GatewayHandler),
+    ('/_ah/warmup', WarmupHandler),
+    ('/_admin/rerender', RerenderHandler),
+    ('/_stats', StatsHandler),
+    ('/_tasks/payments', PaymentsTaskHandler),
+    # short item links, keep this last.  Add new plain-word paths above
+    # to models.RESERVED_SLUGS, so no item gets that slug.
+    webapp2.Route('/<slug:[0-9a-zA-Z]+>', MainHandler),
 ]
 
 app = webapp2.WSGIApplication(app_routes,
     config=config.dev,
     debug=True
 )
+boot.mark('app')
+boot.log()
@@ -54,14 +54,19 @@ Sed eros tortor, blandit at porta eu, feugiat sed massa. Vestibulum placerat veh
 """
 
 
-
-
-import requests
+import os
+import re
+import sys
 import json
+import time
+import hashlib
+import argparse
+import threading
+import collections
 import jinja2
 
 
-template = jinja2.Template("""<!DOCTYPE html>
+TEMPLATE_SOURCE = """<!DOCTYPE html>
 <html>
 <head>
 <meta charset="utf-8">
@@ -75,69 +80,365 @@ template = jinja2.Template("""<!DOCTYPE html>
 {{content}}
 </body>
 </html>
-""")
-
-
-
-data = json.dumps({
-'text': text,
-
-})
-resp = requests.post("https://api.github.com/markdown", data=data)
-print resp.status_code
-with open("out.html", "w") as f:
-    f.write(template.render(content=resp.content))
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+"""
+template = jinja2.Template(TEMPLATE_SOURCE)
+
+# the pages' style.css, copied next to them
+STYLESHEET = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mardown.css')
+
+
+# bump whenever the html `render` produces changes, so anything storing
+# rendered html knows to re-render it.
+RENDERER_VERSION = 1
+
+FENCE_RE = re.compile(r'^ {0,3}(`{3,}|~{3,})\s*([\w+#-]*)\s*$')
+ATX_RE = re.compile(r'^ {0,3}(#{1,6})\s+(.*?)(\s+#+)?\s*$')
+SETEXT_RE = re.compile(r'^ {0,3}(=+|-+)\s*$')
+HR_RE = re.compile(r'^ {0,3}((\*\s*){3,}|(-\s*){3,}|(_\s*){3,})$')
+LIST_RE = re.compile(r'^ {0,3}([*+-]|\d+[.)])\s+(.*)$')
+QUOTE_RE = re.compile(r'^ {0,3}> ?(.*)$')
+
+INLINE_RE = re.compile(
+    r'(?P<tick>`+)(?P<code>.+?)(?P=tick)'
+    r'|\[(?P<label>[^\]]*)\]\((?P<url>[^)\s]*)(?:\s+"(?P<title>[^"]*)")?\)'
+    r'|(?P<auto>https?://[^\s<>]*[^\s<>.,;:!?\'")\]])')
+STRONG_RE = re.compile(r'(\*\*|__)(?=\S)(.+?)(?<=\S)\1')
+EM_RE = re.compile(r'(?<![\w*])\*(?=\S)(.+?)(?<=\S)\*(?![\w*])|(?<!\w)_(?=\S)(.+?)(?<=\S)_(?!\w)')
+SAFE_URL_RE = re.compile(r'^(https?:|mailto:|/|#|\.|[^:]*$)', re.I)
+
+
+def escape(s):
+    return s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+
+
+def _emphasis(s):
+    s = STRONG_RE.sub(r'<strong>\2</strong>', s)
+    return EM_RE.sub(lambda m: '<em>%s</em>' % (m.group(1) or m.group(2)), s)
+
+
+def _link(url, label, title=None):
+    # only allow harmless schemes, no javascript: links and the like
+    if not SAFE_URL_RE.match(url):
+        return label
+    title = ' title="%s"' % escape(title) if title else ''
+    return '<a href="%s"%s>%s</a>' % (escape(url), title, label)
+
+
+def render_inline(s):
+    '''renders code spans, links, autolinks and emphasis, escaping the rest'''
+    out, pos = [], 0
+    for m in INLINE_RE.finditer(s):
+        out.append(_emphasis(escape(s[pos:m.start()])))
+        if m.group('tick'):
+            out.append('<code>%s</code>' % escape(m.group('code').strip()))
+        elif m.group('auto'):
+            out.append(_link(m.group('auto'), escape(m.group('auto'))))
+        else:
+            label = _emphasis(escape(m.group('label')))
+            out.append(_link(m.group('url'), label, m.group('title')))
+        pos = m.end()
+    out.append(_emphasis(escape(s[pos:])))
+    return ''.join(out)
+
+
+def _code_block(lines, lang=''):
+    while lines and not lines[-1].strip():
+        lines = lines[:-1]
+    cls = ' class="lang-%s"' % escape(lang) if lang else ''
+    return '<pre class="code-block"><code%s>%s\n</code></pre>' % (cls, escape('\n'.join(lines)))
+
+
+def render_blocks(lines):
+    '''renders a list of lines of markdown into a list of html blocks'''
+    blocks, para = [], []
+    def flush():
+        if para:
+            blocks.append('<p>%s</p>' % render_inline('\n'.join(para)))
+            del para[:]
+
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+
+        fence = FENCE_RE.match(line)
+        if fence:
+            flush()
+            marker, code = fence.group(1), []
+            i += 1
+            while i < len(lines) and not (lines[i].strip().startswith(marker[0] * len(marker))
+                    and not lines[i].strip().strip(marker[0])):
+                code.append(lines[i])
+                i += 1
+            blocks.append(_code_block(code, fence.group(2)))
+            i += 1
+            continue
+
+        if not line.strip():
+            flush()
+            i += 1
+            continue
+
+        # indented code can't interrupt a paragraph, there it's just a
+        # continuation line
+        if line.startswith('    ') and not para:
+            code = []
+            while i < len(lines) and (lines[i].startswith('    ') or not lines[i].strip()):
+                code.append(lines[i][4:])
+                i += 1
+            blocks.append(_code_block(code))
+            continue
+
+        setext = SETEXT_RE.match(line)
+        if setext and para:
+            level = 1 if setext.group(1)[0] == '=' else 2
+            blocks.append('<h%d>%s</h%d>' % (level, render_inline('\n'.join(para)), level))
+            del para[:]
+            i += 1
+            continue
+
+        atx = ATX_RE.match(line)
+        if atx:
+            flush()
+            level = len(atx.group(1))
+            blocks.append('<h%d>%s</h%d>' % (level, render_inline(atx.group(2)), level))
+            i += 1
+            continue
+
+        if HR_RE.match(line):
+            flush()
+            blocks.append('<hr />')
+            i += 1
+            continue
+
+        item = LIST_RE.match(line)
+        if item and not para:
+            ordered = item.group(1)[0].isdigit()
+            items = []
+            while i < len(lines):
+                item = LIST_RE.match(lines[i])
+                if item and item.group(1)[0].isdigit() == ordered:
+                    items.append([item.group(2)])
+                elif lines[i].strip() and not item and not HR_RE.match(lines[i]) and \
+                        (lines[i].startswith('  ') or lines[i - 1].strip()):
+                    items[-1].append(lines[i].strip())
+                else:
+                    break
+                i += 1
+            tag = 'ol' if ordered else 'ul'
+            blocks.append('<%s>\n%s\n</%s>' % (tag, '\n'.join(
+                '<li>%s</li>' % render_inline('\n'.join(it)) for it in items), tag))
+            continue
+
+        if QUOTE_RE.match(line):
+            flush()
+            quoted = []
+            while i < len(lines) and QUOTE_RE.match(lines[i]):
+                quoted.append(QUOTE_RE.match(lines[i]).group(1))
+                i += 1
+            blocks.append('<blockquote>\n%s\n</blockquote>' % '\n'.join(render_blocks(quoted)))
+            continue
+
+        para.append(line.strip())
+        i += 1
+
+    flush()
+    return blocks
+
+
+class RenderCache(object):
+    '''
+    Bounded, thread safe cache of rendered html, keyed by a hash of the
+    markdown source (and renderer version), so an unchanged document is
+    only ever rendered once.
+    '''
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            html = self._data.pop(key, None)
+            if html is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._data[key] = html
+            return html
+
+    def set(self, key, html):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = html
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+_cache = RenderCache()
+
+
+def content_hash(text):
+    '''hash identifying a document and the renderer version rendering it'''
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return hashlib.sha1('%d\0%s' % (RENDERER_VERSION, text)).hexdigest()
+
+
+def render(text, cache=_cache):
+    '''
+    renders markdown to html locally.  Supports paragraphs, headings, fenced
+    and indented code blocks, lists, block quotes, rules, links, autolinks,
+    code spans and emphasis.  Raw html in the source is escaped, so the
+    output is safe to put on a page.
+    '''
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    key = content_hash(text)
+    html = cache.get(key) if cache else None
+    if html is None:
+        lines = text.expandtabs(4).splitlines()
+        html = u'\n'.join(render_blocks(lines))
+        if cache:
+            cache.set(key, html)
+    return html
+
+
+def render_page(text):
+    '''renders markdown into a full html page, using `template`'''
+    return template.render(content=render(text))
+
+
+MARKDOWN_EXTENSIONS = ('.md', '.markdown', '.mdown')
+BUILD_STATE = '.mardown-build.json'
+
+
+def _build_file(job):
+    # runs in a worker process
+    src_path, out_path = job
+    start = time.time()
+    with open(src_path) as f:
+        html = render_page(f.read())
+    out_dir = os.path.dirname(out_path)
+    if not os.path.isdir(out_dir):
+        try:
+            os.makedirs(out_dir)
+        except OSError:
+            pass
+    with open(out_path, 'w') as f:
+        f.write(html.encode('utf-8'))
+    return out_path, time.time() - start
+
+
+def build_site(src, dst, processes=None, force=False, log=sys.stdout):
+    '''
+    Renders every markdown file under `src` into an html page at the same
+    relative path under `dst` (with a .html extension), spread over a pool
+    of `processes` worker processes (defaults to one per cpu).
+
+    Builds are incremental: a file is only rendered again if its source,
+    the page template or the renderer changed since the last build (or
+    `force` is set).  Pages whose source was removed are deleted.  Returns
+    a dict with `rendered`, `skipped`, `removed`, `seconds` (wall clock)
+    and `render_seconds` (summed over the workers).
+    '''
+    start = time.time()
+    state_path = os.path.join(dst, BUILD_STATE)
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        state = {}
+    template_hash = content_hash(TEMPLATE_SOURCE)
+
+    jobs, new_state, skipped = [], {}, 0
+    for root, dirs, files in os.walk(src):
+        for name in sorted(files):
+            if not name.lower().endswith(MARKDOWN_EXTENSIONS):
+                continue
+            src_path = os.path.join(root, name)
+            rel = os.path.relpath(src_path, src)
+            out_path = os.path.join(dst, os.path.splitext(rel)[0] + '.html')
+            with open(src_path) as f:
+                entry = {'source': content_hash(f.read()), 'template': template_hash}
+            new_state[rel] = entry
+            if not force and state.get(rel) == entry and os.path.exists(out_path):
+                skipped += 1
+            else:
+                jobs.append((src_path, out_path))
+
+    removed = 0
+    for rel in set(state) - set(new_state):
+        out_path = os.path.join(dst, os.path.splitext(rel)[0] + '.html')
+        if os.path.exists(out_path):
+            os.remove(out_path)
+            removed += 1
+
+    if len(jobs) > 1 and processes != 1:
+        # imported here, the app imports this module for `render` and
+        # app engine doesn't allow starting processes
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_build_file, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(_build_file, jobs)
+
+    if not os.path.isdir(dst):
+        os.makedirs(dst)
+    copy_stylesheet(dst)
+    with open(state_path, 'w') as f:
+        json.dump(new_state, f, indent=1, sort_keys=True)
+
+    report = {
+        'rendered': len(results),
+        'skipped': skipped,
+        'removed': removed,
+        'seconds': time.time() - start,
+        'render_seconds': sum(t for path, t in results),
+    }
+    if log:
+        for path, t in sorted(results, key=lambda r: -r[1])[:5]:
+            log.write("  %6.1fms  %s\n" % (t * 1000, os.path.relpath(path, dst)))
+        log.write("rendered %(rendered)d, skipped %(skipped)d, removed %(removed)d "
+            "in %(seconds).2fs (%(render_seconds).2fs rendering)\n" % report)
+    return report
+
+
+def copy_stylesheet(dst):
+    '''puts the pages' style.css into directory `dst`'''
+    with open(STYLESHEET) as f:
+        css = f.read()
+    path = os.path.join(dst, 'style.css')
+    if os.path.exists(path):
+        with open(path) as f:
+            if f.read() == css:
+                return
+    with open(path, 'w') as f:
+        f.write(css)
+
+
+def main(argv):
+    if argv and argv[0] == 'build':
+        parser = argparse.ArgumentParser(prog='mardown.py build',
+            description='render a directory of markdown files to html pages')
+        parser.add_argument('src')
+        parser.add_argument('dst')
+        parser.add_argument('-j', '--processes', type=int, default=None,
+            help='number of worker processes, defaults to one per cpu')
+        parser.add_argument('-f', '--force', action='store_true',
+            help='render all files, even unchanged ones')
+        args = parser.parse_args(argv[1:])
+        build_site(args.src, args.dst, args.processes, args.force)
+        return
+    out = argv[0] if argv else "out.html"
+    with open(out, "w") as f:
+        f.write(render_page(text).encode('utf-8'))
+    copy_stylesheet(os.path.dirname(os.path.abspath(out)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,399 @@
+'''
+datastore models.
+'''
+
+import json
+import logging
+import dwolla
+import mardown
+from decimal import Decimal, InvalidOperation
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+from google.appengine.api import memcache
+from google.appengine.datastore import entity_pb
+
+CENTS = Decimal('0.01')
+# amount_cents has to fit a 64 bit integer property
+MAX_AMOUNT = Decimal('1000000000')
+BASE62 = '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+# paths of other pages (see main.app_routes and app.yaml) that an item's
+# /<slug> link must not shadow
+RESERVED_SLUGS = frozenset(['new', 'login', 'logout', 'confirm', 'gateway',
+    'static', 'favicon'])
+
+
+def base62_encode(n):
+    '''encodes a positive integer as a base62 string'''
+    digits = []
+    while n:
+        n, r = divmod(n, 62)
+        digits.append(BASE62[r])
+    return ''.join(reversed(digits)) or BASE62[0]
+
+
+def base62_decode(s):
+    '''decodes a base62 string, raises `ValueError` for invalid strings'''
+    n = 0
+    for c in s:
+        i = BASE62.find(c)
+        if i < 0:
+            raise ValueError("invalid base62 string: %r" % s)
+        n = n * 62 + i
+    return n
+
+
+def parse_amount(value):
+    '''
+    parses a user entered amount like "$5" or "1,000.50" into a `Decimal`
+    with two decimal places.  Raises `ValueError` if it isn't a positive
+    amount.
+    '''
+    try:
+        amount = Decimal(unicode(value).replace('$', '').replace(',', '').strip())
+        # NaN, Infinity and huge amounts (which quantize refuses) are invalid
+        if not amount.is_finite() or amount > MAX_AMOUNT:
+            raise InvalidOperation()
+        amount = amount.quantize(CENTS)
+    except InvalidOperation:
+        raise ValueError("invalid amount: %r" % value)
+    if amount <= 0:
+        raise ValueError("invalid amount: %r" % value)
+    return amount
+
+
+class Item(db.Model):
+    '''
+    A payment page: asks for `amount` to be paid to dwolla `account`.
+
+    Items don't change once created, so `get_cached` keeps them in memcache
+    and in an in-process cache.  `text` is markdown, it's rendered to
+    `text_html` when the item is saved, never while serving the page.  When
+    the renderer changes, `rerender_items` updates the stored html; other
+    instances may serve the old html for up to `local_ttl` seconds.
+
+    Pages created before this model existed are `Expando` entities, they're
+    converted on first read (see `from_legacy`) or in bulk by
+    `migrate_legacy_items`.
+
+    New items get a short, allocated numeric id, and are linked to as
+    `/<slug>` where the slug is that id in base62.  Decoding the slug gives
+    the key directly, so it needs no extra index lookup.  Ids whose slug
+    would be the path of another page (`RESERVED_SLUGS`) aren't used.
+    Converted legacy items keep their `/?k=<key>` links.
+    '''
+    account = db.StringProperty(required=True)
+    amount_cents = db.IntegerProperty(required=True)
+    text = db.TextProperty(default=u'')
+    text_html = db.TextProperty()
+    html_version = db.IntegerProperty()
+    created = db.DateTimeProperty(auto_now_add=True)
+    updated = db.DateTimeProperty(auto_now=True)
+    legacy_key = db.StringProperty()
+
+    local_cache = dwolla.LRUCache(2000)
+    cache_ttl = 60 * 60
+    # `invalidate` only clears the local cache of the instance it runs on
+    local_ttl = 60
+
+    @property
+    def amount(self):
+        return (Decimal(self.amount_cents) / 100).quantize(CENTS)
+
+    @amount.setter
+    def amount(self, value):
+        self.amount_cents = int(parse_amount(value) * 100)
+
+    @classmethod
+    def create(cls, account, amount, text, **kwargs):
+        '''makes a new (unsaved) item with a freshly allocated id'''
+        amount = parse_amount(amount)
+        if 'key' not in kwargs:
+            item_id = cls.allocate_id()
+            kwargs['key'] = db.Key.from_path(cls.kind(), item_id)
+        item = cls(account=account,
+            amount_cents=int(amount * 100),
+            text=text or u'',
+            **kwargs)
+        item.render_text()
+        return item
+
+    @classmethod
+    def allocate_id(cls):
+        '''allocates a new item id, whose slug isn't another page's path'''
+        while True:
+            item_id = db.allocate_ids(db.Key.from_path(cls.kind(), 1), 1)[0]
+            if base62_encode(item_id) not in RESERVED_SLUGS:
+                return item_id
+
+    def render_text(self):
+        '''renders the markdown `text` into `text_html`'''
+        self.text_html = mardown.render(self.text or u'', cache=None)
+        self.html_version = mardown.RENDERER_VERSION
+
+    def invalidate(self):
+        '''drops the item from memcache (and this instance's cache)'''
+        keys = set([str(self.key()), self.url_key()])
+        for key in keys:
+            self.local_cache.delete(key)
+        memcache.delete_multi(list(keys), namespace='item')
+
+    @classmethod
+    def get_by_slug(cls, slug):
+        '''returns the item for a short slug, or None'''
+        try:
+            item_id = base62_decode(slug)
+        except ValueError:
+            return None
+        if not item_id:
+            return None
+        return cls.get_cached(db.Key.from_path(cls.kind(), item_id))
+
+    @classmethod
+    def get_cached(cls, key):
+        '''
+        returns the item for a (urlsafe) key string, or None if there is no
+        such item.  Reads through the in-process cache and memcache.
+        '''
+        key = str(key)
+        item = cls.local_cache.get(key)
+        if item is not None:
+            return item
+        data = memcache.get(key, namespace='item')
+        if data is not None:
+            item = db.model_from_protobuf(entity_pb.EntityProto(data))
+        else:
+            item = cls._get_uncached(key)
+            if item is None:
+                return None
+            memcache.set(key, db.model_to_protobuf(item).Encode(),
+                time=cls.cache_ttl, namespace='item')
+        cls.local_cache.set(key, item, cls.local_ttl)
+        return item
+
+    @classmethod
+    def _get_uncached(cls, key):
+        try:
+            key = db.Key(key)
+        except (db.BadKeyError, db.BadArgumentError):
+            return None
+        if key.kind() == 'Expando':
+            return cls.from_legacy(key)
+        if key.kind() != cls.kind():
+            return None
+        return cls.get(key)
+
+    @classmethod
+    def from_legacy(cls, key):
+        '''
+        returns the `Item` for an old `Expando` item entity, converting and
+        saving it first if that hasn't happened yet.  Old items without an
+        account can't be paid, they aren't converted and give None.
+        '''
+        item = cls.get_by_key_name(str(key))
+        if item is not None:
+            return item
+        old = db.get(key)
+        if old is None:
+            return None
+        if not getattr(old, 'account', None):
+            logging.warning("not converting legacy item %s without an account", key)
+            return None
+        try:
+            amount = parse_amount(getattr(old, 'amount', None))
+        except ValueError:
+            amount = Decimal('1.00')
+        item = cls(key_name=str(key),
+            account=old.account,
+            amount_cents=int(amount * 100),
+            text=getattr(old, 'text', None) or u'',
+            legacy_key=str(key))
+        item.render_text()
+        item.put()
+        return item
+
+    def url_key(self):
+        '''the key string used in ?k= links to this item'''
+        return self.legacy_key or str(self.key())
+
+    @property
+    def version(self):
+        '''when the item last changed, for cache validation'''
+        return self.updated or self.created
+
+    @property
+    def slug(self):
+        '''short base62 slug for the item, None for converted legacy items'''
+        if self.key().id():
+            return base62_encode(self.key().id())
+        return None
+
+    def url_path(self):
+        '''path of the item's page'''
+        if self.slug and self.slug not in RESERVED_SLUGS:
+            return '/%s' % self.slug
+        return '/?k=%s' % self.url_key()
+
+
+def migrate_legacy_items(cursor=None, batch_size=100):
+    '''
+    Converts all old `Expando` items to `Item`s, `batch_size` at a time,
+    chaining itself on the deferred task queue until done::
+
+        deferred.defer(models.migrate_legacy_items)
+    '''
+    q = db.Query(db.Expando, keys_only=True)
+    if cursor:
+        q.with_cursor(cursor)
+    keys = q.fetch(batch_size)
+    for key in keys:
+        try:
+            Item.from_legacy(key)
+        except db.BadValueError as e:
+            # don't let one broken item stop the rest of the migration
+            logging.error("could not convert legacy item %s: %s", key, e)
+    logging.info("migrated %d legacy items", len(keys))
+    if len(keys) == batch_size:
+        deferred.defer(migrate_legacy_items, q.cursor(), batch_size)
+
+
+def rerender_items(cursor=None, batch_size=100):
+    '''
+    Re-renders the `text_html` of all items rendered by an older version of
+    the markdown renderer, `batch_size` at a time, chaining itself on the
+    deferred task queue until done::
+
+        deferred.defer(models.rerender_items)
+    '''
+    q = Item.all()
+    if cursor:
+        q.with_cursor(cursor)
+    items = q.fetch(batch_size)
+    stale = [item for item in items if item.html_version != mardown.RENDERER_VERSION]
+    for item in stale:
+        item.render_text()
+    db.put(stale)
+    for item in stale:
+        item.invalidate()
+    logging.info("re-rendered %d of %d items", len(stale), len(items))
+    if len(items) == batch_size:
+        deferred.defer(rerender_items, q.cursor(), batch_size)
+
+
+class TransactionSyncState(db.Model):
+    '''
+    Sync bookkeeping for one dwolla account, key_name is the account id.
+    Also the entity group parent of the account's `Transaction` entities.
+    '''
+    high_water = db.DateTimeProperty()
+    last_sync = db.DateTimeProperty()
+
+
+class Transaction(db.Model):
+    '''
+    A dwolla transaction stored locally.  The key's id is the dwolla
+    transaction Id, and the parent is the account's `TransactionSyncState`,
+    so saving the same transaction twice just overwrites it.
+    '''
+    account = db.StringProperty(required=True)
+    type = db.StringProperty()
+    amount = db.FloatProperty()
+    date = db.DateTimeProperty()
+    status = db.StringProperty()
+    source_id = db.StringProperty()
+    destination_id = db.StringProperty()
+    notes = db.TextProperty()
+    data = db.TextProperty()
+
+    @property
+    def tx_id(self):
+        return self.key().id()
+
+    @classmethod
+    def from_api(cls, parent, tx):
+        '''makes an entity from a transaction dict returned by the api'''
+        return cls(key=db.Key.from_path(cls.kind(), int(tx['Id']), parent=parent),
+            account=parent.name(),
+            type=tx.get('Type'),
+            amount=float(tx.get('Amount') or 0),
+            date=dwolla.parse_date(tx.get('Date')),
+            status=tx.get('Status'),
+            source_id=tx.get('SourceId'),
+            destination_id=tx.get('DestinationId'),
+            notes=tx.get('Notes'),
+            data=json.dumps(tx))
+
+    def to_dict(self):
+        '''returns the transaction as the api returned it'''
+        return json.loads(self.data)
+
+
+class PayoutBatch(db.Model):
+    '''A bulk payout of `size` rows, see `PayoutRow`.'''
+    account = db.StringProperty()
+    status = db.StringProperty(default='pending',
+        choices=['pending', 'running', 'done'])
+    size = db.IntegerProperty(default=0)
+    created = db.DateTimeProperty(auto_now_add=True)
+    updated = db.DateTimeProperty(auto_now=True)
+
+    def row_keys(self):
+        return [PayoutRow.key_for(self, i) for i in range(self.size)]
+
+
+class PayoutRow(db.Model):
+    '''
+    One payment of a `PayoutBatch`.  Status goes pending -> sending -> sent
+    or failed.  A row left in 'sending' (e.g. the batch crashed mid request)
+    is checked against the account's transactions for its `idempotency_key`
+    before it is ever sent again.
+
+    Rows are root entities (so they can be written concurrently) with key
+    names derived from the batch id and row index, so a batch's rows can be
+    fetched by key without an (eventually consistent) query.
+    '''
+    batch = db.ReferenceProperty(PayoutBatch, required=True)
+    index = db.IntegerProperty(required=True)
+    dest = db.StringProperty(required=True)
+    amount = db.StringProperty(required=True)
+    notes = db.StringProperty(default='')
+    idempotency_key = db.StringProperty(required=True)
+    status = db.StringProperty(default='pending',
+        choices=['pending', 'sending', 'sent', 'failed'])
+    transaction_id = db.IntegerProperty()
+    error = db.TextProperty()
+    attempts = db.IntegerProperty(default=0)
+    updated = db.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def key_for(cls, batch, index):
+        return db.Key.from_path(cls.kind(), 'b%d-r%d' % (batch.key().id(), index))
+
+
+class Payment(db.Model):
+    '''
+    A payment made through the off-site gateway, as reported by dwolla's
+    callback to /confirm (see `payments.py`).  The key name is derived from
+    the dwolla CheckoutId, so repeated notifications for a checkout update
+    one entity.  `order_id` is the `url_key` of the item that was paid for.
+    '''
+    order_id = db.StringProperty()
+    amount_cents = db.IntegerProperty()
+    status = db.StringProperty()
+    transaction_id = db.IntegerProperty()
+    test = db.BooleanProperty(default=False)
+    error = db.TextProperty()
+    data = db.TextProperty()
+    created = db.DateTimeProperty(auto_now_add=True)
+    updated = db.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def key_for(cls, checkout_id):
+        return db.Key.from_path(cls.kind(), 'c-%s' % checkout_id)
+
+    @property
+    def checkout_id(self):
+        return self.key().name()[2:]
+
+    @property
+    def amount(self):
+        return (Decimal(self.amount_cents or 0) / 100).quantize(CENTS)
@@ -0,0 +1,122 @@
+'''
+recording gateway payments.
+
+Dwolla posts the result of every checkout to the callback url we gave it
+(/confirm).  `ConfirmHandler` only checks the signature and adds the raw
+notification to the `payments` pull queue (see queue.yaml), so it answers
+quickly however many payments come in at once.  Every minute, cron calls
+/_tasks/payments, which runs `process`: it leases the queued
+notifications in batches, saves them as `models.Payment` entities (one
+per CheckoutId, however often dwolla notified us) and deletes the tasks.
+
+Queued notifications aren't leased in the order they came in, so a late
+or repeated notification must not undo a final status: once a payment is
+'Failed' only 'Completed' replaces it, and 'Completed' is never replaced.
+'''
+
+import json
+import time
+import logging
+from decimal import Decimal
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+
+from models import Payment, CENTS
+
+QUEUE = 'payments'
+# final statuses, a notification only replaces one with a higher rank
+FINAL_STATUS_RANK = {'Failed': 1, 'Completed': 2}
+
+
+def parse(payload):
+    '''returns the notification dict of a callback body'''
+    notification = json.loads(payload)
+    if not isinstance(notification, dict) or not notification.get('CheckoutId'):
+        raise ValueError("not a gateway notification: %r" % payload[:200])
+    return notification
+
+
+def verify(gateway, notification):
+    '''checks the notification's signature with `gateway`'''
+    if not notification.get('Signature') or notification.get('Amount') is None:
+        return False
+    try:
+        return gateway.verify_gateway_signature(notification['Signature'],
+            notification['CheckoutId'], notification['Amount'])
+    except (TypeError, ValueError):
+        return False
+
+
+def supersedes(status, old_status):
+    '''whether a notification with `status` replaces a payment's `old_status`'''
+    old_rank = FINAL_STATUS_RANK.get(old_status)
+    if old_rank is None:
+        return True
+    return FINAL_STATUS_RANK.get(status, 0) > old_rank
+
+
+def enqueue(payload):
+    '''adds a (verified) raw callback body to the queue'''
+    taskqueue.Queue(QUEUE).add(taskqueue.Task(payload=payload, method='PULL'))
+
+
+def process(batch_size=100, lease_seconds=60, deadline=50):
+    '''
+    Stores queued notifications until the queue is empty, or `deadline`
+    seconds have passed.  Returns the number of notifications handled.
+    '''
+    queue = taskqueue.Queue(QUEUE)
+    start = time.time()
+    handled = 0
+    while time.time() - start < deadline:
+        tasks = queue.lease_tasks(lease_seconds, batch_size)
+        if not tasks:
+            break
+        save(tasks)
+        queue.delete_tasks(tasks)
+        handled += len(tasks)
+        if len(tasks) < batch_size:
+            break
+    return handled
+
+
+def save(tasks):
+    '''saves the notifications of a batch of leased tasks'''
+    # the latest notification of each checkout in the batch
+    notifications = {}
+    for task in tasks:
+        try:
+            notification = parse(task.payload)
+        except ValueError as e:
+            # it was verified before it was queued, so this shouldn't happen
+            logging.error("dropping payment notification: %s", e)
+            continue
+        checkout_id = notification['CheckoutId']
+        seen = notifications.get(checkout_id)
+        if seen is None or supersedes(notification.get('Status'), seen.get('Status')):
+            notifications[checkout_id] = notification
+    if not notifications:
+        return
+
+    keys = [Payment.key_for(checkout_id) for checkout_id in notifications]
+    existing = dict((p.checkout_id, p) for p in db.get(keys) if p)
+    changed = []
+    for checkout_id, notification in notifications.items():
+        payment = existing.get(checkout_id)
+        if payment is not None and (payment.status == notification.get('Status')
+                or not supersedes(notification.get('Status'), payment.status)):
+            continue
+        if payment is None:
+            payment = Payment(key=Payment.key_for(checkout_id))
+        amount = Decimal(str(notification.get('Amount') or 0)).quantize(CENTS)
+        payment.order_id = notification.get('OrderId') or None
+        payment.amount_cents = int(amount * 100)
+        payment.status = notification.get('Status')
+        payment.transaction_id = int(notification['TransactionId']) \
+            if notification.get('TransactionId') else None
+        payment.test = str(notification.get('TestMode')).lower() == 'true'
+        payment.error = notification.get('Error') or None
+        payment.data = json.dumps(notification)
+        changed.append(payment)
+    db.put(changed)
+    logging.info("saved %d payments (%d notifications)", len(changed), len(tasks))
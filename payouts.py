@@ -0,0 +1,199 @@
+'''
+bulk payouts over `DwollaUser.send_funds`.
+
+    payouts = BulkPayout(dwolla.DwollaUser(token), pin, concurrency=10)
+    batch = payouts.create_batch([('812-111-1111', '5.00', 'thanks!'), ...])
+    report = payouts.run(batch)
+
+Rows are sent concurrently, at most `concurrency` at a time.  Progress is
+saved per row in the datastore, so calling `run` again on a batch that
+crashed (or timed out) picks up where it left off.  Every row has an
+idempotency key which is appended to the transaction notes; a row whose
+send was interrupted is looked up by that key in the account's sent
+transactions before it is retried, so a payment is never sent twice.
+'''
+
+import hashlib
+import logging
+import datetime
+from decimal import Decimal
+from google.appengine.ext import db
+
+import dwolla
+from models import PayoutBatch, PayoutRow
+
+# dwolla limits transaction notes to 250 characters
+MAX_NOTES = 250
+REF_FORMAT = ' [ref:%s]'
+
+
+class BulkPayout(object):
+    '''
+    Sends a batch of payments from one account.
+
+    :param api: `dwolla.DwollaUser` of the paying account.
+
+    :param pin: the account's PIN, needed by `send_funds`.
+
+    :param concurrency: (optional) how many payments to have in flight at
+        once. Defaults to 5.
+
+    :param send_args: (optional) extra keyword arguments for every
+        `send_funds` call, e.g. `funds_source` or `assume_cost`.
+    '''
+    def __init__(self, api, pin, concurrency=5, **send_args):
+        self.api = api
+        self.pin = pin
+        self.concurrency = concurrency
+        self.send_args = send_args
+
+    def create_batch(self, rows, account=None):
+        '''
+        Saves a new batch and returns its `PayoutBatch`.  Nothing is sent
+        until `run` is called.
+
+        :param rows: list of `(dest, amount, notes)` tuples.
+
+        :param account: (optional) dwolla id of the paying account, only
+            used for bookkeeping.
+        '''
+        rows = [(dest, Decimal(str(amount)).quantize(Decimal('0.01')), notes)
+            for dest, amount, notes in rows]
+        for i, (dest, amount, notes) in enumerate(rows):
+            if amount <= 0:
+                raise ValueError("row %d: invalid amount %s" % (i, amount))
+
+        # the rows are saved before the batch, so a crash in between leaves
+        # orphan rows rather than a batch with missing rows
+        batch_id = db.allocate_ids(db.Key.from_path(PayoutBatch.kind(), 1), 1)[0]
+        batch = PayoutBatch(key=db.Key.from_path(PayoutBatch.kind(), batch_id),
+            account=account, size=len(rows))
+        entities = []
+        for i, (dest, amount, notes) in enumerate(rows):
+            entities.append(PayoutRow(key=PayoutRow.key_for(batch, i),
+                batch=batch,
+                index=i,
+                dest=dest,
+                amount=str(amount),
+                notes=notes or '',
+                idempotency_key=self.idempotency_key(batch.key(), i, dest, amount)))
+        for i in range(0, len(entities), 100):
+            db.put(entities[i:i + 100])
+        batch.put()
+        return batch
+
+    def idempotency_key(self, batch_key, index, dest, amount):
+        raw = '%s:%d:%s:%s' % (batch_key, index, dest, amount)
+        return hashlib.sha1(raw).hexdigest()[:16]
+
+    def run(self, batch):
+        '''
+        Sends all rows of the batch that weren't sent yet and returns a
+        report (see `report`).  Safe to call again after a crash or on a
+        finished batch, but not while another `run` of the same batch is
+        still going.
+
+        :param batch: `PayoutBatch` or its key.
+        '''
+        if not isinstance(batch, PayoutBatch):
+            batch = PayoutBatch.get(batch)
+        batch.status = 'running'
+        batch.put()
+
+        rows = self.get_rows(batch)
+        self.reconcile(batch, [r for r in rows if r.status == 'sending'])
+
+        pending = [r for r in rows if r.status == 'pending']
+        executor = dwolla.Executor(max_workers=self.concurrency)
+        dwolla.gather(*executor.map(self.send_row, pending), return_exceptions=True)
+
+        report = self.report(batch)
+        if not report['sending'] and not report['pending']:
+            batch.status = 'done'
+            batch.put()
+        return report
+
+    def send_row(self, row):
+        row.status = 'sending'
+        row.attempts += 1
+        row.put()
+        try:
+            tx_id = self.api.send_funds(float(row.amount), row.dest, self.pin,
+                notes=self.notes(row), **self.send_args)
+        except dwolla.RequestNotSentError as e:
+            # rate limited or circuit open, try again on the next run
+            row.status = 'pending'
+            row.error = unicode(e)
+        except dwolla.DwollaUnavailableError as e:
+            logging.warning("payout row %d: %s", row.index, e)
+            row.error = unicode(e)
+        except dwolla.DwollaAPIError as e:
+            # dwolla refused the payment, so nothing was sent
+            row.status = 'failed'
+            row.error = unicode(e)
+        except Exception as e:
+            # we don't know whether it went through, leave the row in
+            # 'sending' and let `reconcile` sort it out on the next run
+            logging.warning("payout row %d: %s", row.index, e)
+            row.error = unicode(e)
+        else:
+            row.status = 'sent'
+            row.transaction_id = int(tx_id)
+            row.error = None
+        row.put()
+        return row
+
+    def notes(self, row):
+        ref = REF_FORMAT % row.idempotency_key
+        return row.notes[:MAX_NOTES - len(ref)] + ref
+
+    def reconcile(self, batch, rows):
+        '''
+        Checks rows left in 'sending' by an interrupted run against the
+        account's sent transactions. Rows found there are marked sent, the
+        others go back to pending.
+        '''
+        if not rows:
+            return
+        by_ref = dict((REF_FORMAT % r.idempotency_key, r) for r in rows)
+        since = batch.created.date() - datetime.timedelta(days=1)
+        for tx in self.api.iter_transactions(since=since, types='money_sent'):
+            for ref, row in by_ref.items():
+                if (tx.get('Notes') or '').endswith(ref):
+                    row.status = 'sent'
+                    row.transaction_id = int(tx['Id'])
+                    row.error = None
+                    del by_ref[ref]
+            if not by_ref:
+                break
+        for row in by_ref.values():
+            row.status = 'pending'
+        db.put(rows)
+
+    def get_rows(self, batch):
+        keys = batch.row_keys()
+        rows = []
+        for i in range(0, len(keys), 500):
+            rows.extend(db.get(keys[i:i + 500]))
+        missing = [i for i, row in enumerate(rows) if row is None]
+        if missing:
+            # only batches saved before rows were written first can have these
+            logging.error("payout batch %d is missing rows %s",
+                batch.key().id(), missing)
+        return [row for row in rows if row is not None]
+
+    def report(self, batch):
+        '''
+        Returns a dict with the number of rows per status (`pending`,
+        `sending`, `sent`, `failed`), the total amount sent, and `rows`, a
+        list of `(index, dest, amount, status, transaction_id, error)`.
+        '''
+        report = {'pending': 0, 'sending': 0, 'sent': 0, 'failed': 0,
+            'total_sent': Decimal('0.00'), 'rows': []}
+        for row in self.get_rows(batch):
+            report[row.status] += 1
+            if row.status == 'sent':
+                report['total_sent'] += Decimal(row.amount)
+            report['rows'].append((row.index, row.dest, row.amount,
+                row.status, row.transaction_id, row.error))
+        return report
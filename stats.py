@@ -0,0 +1,136 @@
+'''
+request statistics for the /_stats page.
+
+Each instance aggregates its own numbers in process: the dwolla client's
+per-endpoint stats (`dwolla.stats.default_stats`) and handler timings
+recorded by `BaseHandler.dispatch`.  Every `FLUSH_INTERVAL` seconds (on
+the next request) an instance writes its totals to memcache under its
+own key, and adds itself to the list of instances of its version, which
+`load` uses to add up the numbers of all instances.
+'''
+
+import os
+import time
+import uuid
+import logging
+import threading
+from google.appengine.api import memcache
+from dwolla import stats as dwolla_stats
+
+NAMESPACE = 'stats'
+FLUSH_INTERVAL = 30
+# instances that stop flushing (shut down) drop out after this long
+INSTANCE_TTL = 24 * 60 * 60
+MAX_INSTANCES = 100
+
+INSTANCE = os.environ.get('INSTANCE_ID') or uuid.uuid4().hex
+handlers = dwolla_stats.Stats()
+
+_last_flush = time.time()
+_lock = threading.Lock()
+
+
+def version():
+    return os.environ.get('CURRENT_VERSION_ID')
+
+
+def record_handler(handler, seconds, error=None):
+    '''records a request served by `handler`'''
+    name = '%s %s' % (handler.__class__.__name__, handler.request.method)
+    status = handler.response.status_int
+    if error is not None:
+        # self.abort(4xx) raises an HTTPException carrying its status
+        status = getattr(error, 'code', 500)
+        if status < 500:
+            error = None
+    handlers.record(name, seconds, len(handler.request.body or ''),
+        len(handler.response.body or ''), status, error)
+
+
+def maybe_flush():
+    '''flushes if the last flush was over `FLUSH_INTERVAL` seconds ago'''
+    global _last_flush
+    with _lock:
+        now = time.time()
+        if now - _last_flush < FLUSH_INTERVAL:
+            return
+        _last_flush = now
+    flush()
+
+
+def flush():
+    '''writes this instance's totals to memcache'''
+    data = {
+        'instance': INSTANCE,
+        'version': version(),
+        'started': handlers.started,
+        'flushed': time.time(),
+        'dwolla': dwolla_stats.default_stats.snapshot(),
+        'handlers': handlers.snapshot(),
+    }
+    try:
+        memcache.set('instance:%s' % INSTANCE, data,
+            time=INSTANCE_TTL, namespace=NAMESPACE)
+        _register()
+    except Exception:
+        logging.exception("could not flush request stats")
+
+
+def _register():
+    '''adds this instance to its version's list of instances'''
+    key = 'instances:%s' % version()
+    client = memcache.Client()
+    for attempt in range(5):
+        instances = client.gets(key, namespace=NAMESPACE)
+        if instances is None:
+            if client.add(key, [INSTANCE], namespace=NAMESPACE):
+                return
+            continue
+        if INSTANCE in instances:
+            return
+        instances = (instances + [INSTANCE])[-MAX_INSTANCES:]
+        if client.cas(key, instances, namespace=NAMESPACE):
+            return
+
+
+def load():
+    '''
+    returns the numbers of all instances of the current version, as a dict
+    with `instances` (the flushed data of each), the merged `dwolla` and
+    `handlers` stats, and `boot`, the startup timings (see `boot.log`).
+    '''
+    flush()
+    ids = memcache.get('instances:%s' % version(), namespace=NAMESPACE) or []
+    found = memcache.get_multi(['instance:%s' % i for i in ids], namespace=NAMESPACE)
+    instances = sorted(found.values(), key=lambda data: data['started'])
+    return {
+        'instances': instances,
+        'dwolla': dwolla_stats.merge([data['dwolla'] for data in instances]),
+        'handlers': dwolla_stats.merge([data['handlers'] for data in instances]),
+        'boot': memcache.get('boot:%s' % version(), namespace=NAMESPACE),
+    }
+
+
+def table(entries):
+    '''turns merged stats into rows for display, slowest (p95) first'''
+    rows = []
+    for name, entry in entries.items():
+        count = entry['count'] or 1
+        lookups = entry['cache_hits'] + entry['cache_misses']
+        rows.append({
+            'name': name,
+            'count': entry['count'],
+            'errors': entry['errors'],
+            'error_classes': sorted(entry['error_classes'].items(),
+                key=lambda item: -item[1]),
+            'mean': entry['seconds'] / count * 1000,
+            'p50': dwolla_stats.percentile(entry, 50),
+            'p95': dwolla_stats.percentile(entry, 95),
+            'p99': dwolla_stats.percentile(entry, 99),
+            'max': entry['max'] * 1000,
+            'sent': entry['sent'] / count,
+            'received': entry['received'] / count,
+            'cache_hit_rate': float(entry['cache_hits']) / lookups if lookups else None,
+        })
+    rows.sort(key=lambda row: -row['p95'])
+    return rows
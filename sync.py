@@ -0,0 +1,127 @@
+'''
+incremental sync of dwolla transactions into the datastore.
+
+    sync = TransactionSync(dwolla.DwollaUser(token))
+    sync.sync()                   # one small delta call after the first run
+    sync.query(types='money_received', since=last_week)
+    sync.stats().by_period('month')   # computed from the local copy
+
+The first sync pulls the full history, later ones only ask dwolla for
+transactions since the newest one we have (`sinceDate` only has day
+granularity, so that day is fetched again and deduped by transaction Id).
+'''
+
+import datetime
+import dwolla
+from google.appengine.ext import db
+from models import Transaction, TransactionSyncState
+
+
+class TransactionSync(object):
+    '''
+    Keeps a local copy of one account's transactions up to date.
+
+    :param api: `dwolla.DwollaUser` for the account.
+
+    :param account_id: (optional) dwolla id of the account. Looked up via
+        `api.get_account_info()` if not given.
+
+    :param batch_size: (optional) number of transactions written per
+        datastore put. Defaults to 100.
+    '''
+    def __init__(self, api, account_id=None, batch_size=100):
+        self.api = api
+        self.account_id = account_id or str(api.get_account_info()['Id'])
+        self.batch_size = batch_size
+
+    @property
+    def state_key(self):
+        return db.Key.from_path('TransactionSyncState', self.account_id)
+
+    def get_state(self):
+        return TransactionSyncState.get(self.state_key) or \
+            TransactionSyncState(key_name=self.account_id)
+
+    def sync(self, full=False):
+        '''
+        Fetches transactions newer than the high-water mark and saves them.
+        Returns the number of transactions written.
+
+        :param full: (optional) ignore the high-water mark and re-fetch
+            the whole history. Defaults to False.
+        '''
+        state = self.get_state()
+        # without a sinceDate dwolla only returns the last 7 days
+        since = datetime.date(2000, 1, 1)
+        if state.high_water and not full:
+            since = state.high_water.date()
+
+        high_water = state.high_water
+        batch, written = [], 0
+        for tx in self.api.iter_transactions(since=since):
+            entity = Transaction.from_api(self.state_key, tx)
+            if entity.date and (high_water is None or entity.date > high_water):
+                high_water = entity.date
+            batch.append(entity)
+            if len(batch) >= self.batch_size:
+                db.put(batch)
+                written += len(batch)
+                batch = []
+        if batch:
+            db.put(batch)
+            written += len(batch)
+
+        state.high_water = high_water
+        state.last_sync = datetime.datetime.utcnow()
+        state.put()
+        return written
+
+    def query(self, types=None, since=None, until=None):
+        '''
+        Returns a query for the locally stored transactions, newest first.
+
+        :param types: (optional) '|' delimited string, or list of
+            transaction types to include.
+
+        :param since: (optional) only include transactions on or after
+            this `datetime.datetime`.
+
+        :param until: (optional) only include transactions before this
+            `datetime.datetime`.
+        '''
+        q = Transaction.all().ancestor(self.state_key)
+        if types:
+            if isinstance(types, basestring):
+                types = types.split('|')
+            q.filter('type IN', list(types))
+        if since:
+            q.filter('date >=', since)
+        if until:
+            q.filter('date <', until)
+        return q.order('-date')
+
+    def get_transaction(self, transaction_id):
+        '''returns a stored transaction dict by its Id, or None'''
+        tx = Transaction.get_by_id(int(transaction_id), parent=self.state_key)
+        return tx.to_dict() if tx else None
+
+    def get_transaction_list(self, since=None, types=None, limit=10, skip=0):
+        '''
+        Local version of `DwollaUser.get_transaction_list`, returns the
+        stored transactions as dicts without calling dwolla.  Like the api,
+        `since` can be a 'mm-dd-YYYY' string.
+        '''
+        if isinstance(since, basestring):
+            since = datetime.datetime.strptime(since, '%m-%d-%Y') if since else None
+        elif isinstance(since, datetime.date) and not isinstance(since, datetime.datetime):
+            since = datetime.datetime.combine(since, datetime.time())
+        return [tx.to_dict() for tx in self.query(types, since).fetch(limit, skip)]
+
+    def stats(self, types=None, since=None, until=None):
+        '''
+        Returns a `dwolla.TransactionStats` over the stored transactions
+        matching the filters (see `query`), without calling dwolla.
+        '''
+        q = self.query(types, since, until)
+        table = dwolla.TransactionTable(tx.to_dict() for tx in q.run(batch_size=500))
+        return dwolla.TransactionStats(table, self.account_id)
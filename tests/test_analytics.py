@@ -0,0 +1,68 @@
+'''
+tests for dwolla.analytics
+'''
+
+import datetime
+import unittest
+
+import dwolla
+from dwolla.analytics import get_numpy
+
+ACCOUNT = '812-111-1111'
+
+
+def tx(id, amount, date, type='money_received', other='812-222-2222'):
+    source, dest = (other, ACCOUNT) if type == 'money_received' else (ACCOUNT, other)
+    return {'Id': id, 'Amount': amount, 'Date': date, 'Type': type,
+        'SourceId': source, 'DestinationId': dest}
+
+
+TRANSACTIONS = [
+    tx(1, 0.1, '03/01/2012 10:00:00'),
+    tx(2, 0.2, '03/01/2012 23:59:59'),
+    tx(3, 5.0, '03/06/2012 08:00:00', 'money_sent', '812-333-3333'),
+    tx(4, 0.25, '03/06/2012 09:00:00', 'fee', '812-444-4444'),
+    tx(5, 12.5, '04/15/2012 12:00:00'),
+    tx(6, 7.0, ''),
+    tx(7, 3.0, None, 'money_sent'),
+]
+
+
+class TransactionStatsTest(unittest.TestCase):
+    def stats(self, use_numpy=False):
+        return dwolla.TransactionStats(dwolla.TransactionTable(TRANSACTIONS),
+            ACCOUNT, use_numpy=use_numpy)
+
+    def test_by_period_leaves_out_dateless_rows(self):
+        stats = self.stats()
+        self.assertEqual(stats.by_period('month'), [
+            (datetime.date(2012, 3, 1), {'TransactionsCount': 4, 'TransactionsTotal': 5.55}),
+            (datetime.date(2012, 4, 1), {'TransactionsCount': 1, 'TransactionsTotal': 12.5}),
+        ])
+        self.assertEqual([d for d, s in stats.by_period('day')], [
+            datetime.date(2012, 3, 1), datetime.date(2012, 3, 6), datetime.date(2012, 4, 15)])
+        self.assertEqual([d for d, s in stats.by_period('week')], [
+            datetime.date(2012, 2, 27), datetime.date(2012, 3, 5), datetime.date(2012, 4, 9)])
+
+    def test_totals_are_exact(self):
+        self.assertEqual(self.stats().stats('money_received', end_date='03-01-2012'),
+            {'TransactionsCount': 2, 'TransactionsTotal': 0.3})
+
+    @unittest.skipIf(get_numpy() is None, "numpy is not installed")
+    def test_numpy_and_python_agree(self):
+        plain, fast = self.stats(False), self.stats(True)
+        self.assertTrue(fast.np is not None)
+        for period in ('day', 'week', 'month'):
+            self.assertEqual(fast.by_period(period), plain.by_period(period))
+            self.assertEqual(fast.by_period(period, types='money_sent'),
+                plain.by_period(period, types='money_sent'))
+        self.assertEqual(fast.by_type(), plain.by_type())
+        self.assertEqual(fast.by_counterparty(), plain.by_counterparty())
+        self.assertEqual(fast.stats(), plain.stats())
+        self.assertEqual(fast.stats(start_date=datetime.date(2012, 3, 2)),
+            plain.stats(start_date=datetime.date(2012, 3, 2)))
+        self.assertEqual(fast.fees(), plain.fees())
+
+
+if __name__ == '__main__':
+    unittest.main()
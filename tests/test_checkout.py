@@ -0,0 +1,61 @@
+'''
+tests for gateway carts and bulk checkout creation
+'''
+
+import unittest
+from decimal import Decimal
+
+import dwolla
+from dwolla.transport import FakeDwollaTransport
+
+CHECKOUT_URL = 'https://www.dwolla.com/payment/checkout/'
+
+
+class CartTest(unittest.TestCase):
+    def test_totals_are_exact(self):
+        cart = dwolla.Cart('812-111-1111')
+        for i in range(3):
+            cart.add('thing', 0.1)
+        self.assertEqual(cart.subtotal, Decimal('0.30'))
+        self.assertEqual(cart.total, Decimal('0.30'))
+        self.assertEqual(cart.purchase_order()['Total'], 0.3)
+
+    def test_total_with_quantities_and_extras(self):
+        cart = dwolla.Cart('812-111-1111', discount='1.10', shipping=2.2, tax='0.335')
+        cart.add('a', '19.99', qty=3).add('b', 0.7)
+        self.assertEqual(cart.tax, Decimal('0.34'))
+        self.assertEqual(cart.subtotal, Decimal('60.67'))
+        self.assertEqual(cart.total, Decimal('62.11'))
+        order = cart.purchase_order()
+        self.assertEqual(order['Discount'], -1.1)
+        self.assertEqual([p['Price'] for p in order['OrderItems']], [19.99, 0.7])
+
+
+class CreateCheckoutsTest(unittest.TestCase):
+    def setUp(self):
+        self.transport = FakeDwollaTransport(latency=(0, 0.02))
+        self.gateway = dwolla.DwollaGateway('key', 'secret', 'http://app/gateway',
+            transport=self.transport)
+        self.gateway.stats = None
+
+    def cart(self, order_id, dest='812-111-1111'):
+        return dwolla.Cart(dest, order_id=order_id).add('Invoice %s' % order_id, '5.00')
+
+    def test_one_failed_order_does_not_stop_the_others(self):
+        carts = [self.cart('o%d' % i) for i in range(6)]
+        carts[2] = self.cart('o2', dest='')
+        results = self.gateway.create_checkouts(carts, concurrency=3)
+
+        self.assertEqual([r[0] for r in results], ['o%d' % i for i in range(6)])
+        order_id, url, error = results[2]
+        self.assertEqual(url, None)
+        self.assertTrue(isinstance(error, dwolla.DwollaAPIError))
+        for order_id, url, error in results[:2] + results[3:]:
+            self.assertEqual(error, None)
+            checkout = self.transport.checkouts[url[len(CHECKOUT_URL):]]
+            self.assertEqual(checkout['OrderId'], order_id)
+        self.assertEqual(len(self.transport.checkouts), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+'''
+tests for the markdown renderer in mardown.py.  Item pages output its
+html unescaped, so anything it lets through ends up on the page.
+'''
+
+import unittest
+
+import mardown
+
+
+def render(text):
+    return mardown.render(text, cache=None)
+
+
+class EscapingTest(unittest.TestCase):
+    def assertNoMarkup(self, html, *fragments):
+        for fragment in fragments:
+            self.assertFalse(fragment in html, '%r in %r' % (fragment, html))
+
+    def test_raw_html_is_escaped(self):
+        self.assertEqual(render('<script>alert(1)</script>'),
+            '<p>&lt;script&gt;alert(1)&lt;/script&gt;</p>')
+        self.assertNoMarkup(render('# <img src=x onerror=alert(1)>'), '<img')
+        self.assertNoMarkup(render('> <iframe src="http://x">'), '<iframe')
+        self.assertNoMarkup(render('* <b onclick="x">item</b>'), '<b ')
+
+    def test_code_is_escaped(self):
+        self.assertEqual(render('`<b>`'), '<p><code>&lt;b&gt;</code></p>')
+        self.assertNoMarkup(render('    <i>code</i>'), '<i>')
+        self.assertNoMarkup(render('```html\n<script>x</script>\n```'), '<script')
+        self.assertNoMarkup(render('```"><script>\nx\n```'), '<script')
+
+    def test_unsafe_link_schemes_are_dropped(self):
+        for url in ['javascript:alert(1)', 'JaVaScRiPt:alert(1)',
+                'data:text/html;base64,PHNjcmlwdD4=', 'vbscript:msgbox(1)',
+                'java&#115;cript:alert(1)']:
+            html = render('[click](%s)' % url)
+            self.assertNoMarkup(html, '<a', 'href')
+            self.assertTrue('click' in html)
+
+    def test_link_attributes_are_escaped(self):
+        html = render('[x](http://a.com/"onmouseover="alert(1) "a"b")')
+        self.assertNoMarkup(html, '"onmouseover')
+        html = render('[x](http://a.com/ "t\\" onclick=\\"x")')
+        self.assertNoMarkup(html, '" onclick')
+
+    def test_safe_links_are_kept(self):
+        self.assertEqual(render('[ok](http://a.com/?a=1&b=2 "t")'),
+            '<p><a href="http://a.com/?a=1&amp;b=2" title="t">ok</a></p>')
+        self.assertEqual(render('[home](/)'), '<p><a href="/">home</a></p>')
+        self.assertEqual(render('[mail](mailto:a@b.com)'),
+            '<p><a href="mailto:a@b.com">mail</a></p>')
+        self.assertEqual(render('see https://a.com/x.'),
+            '<p>see <a href="https://a.com/x">https://a.com/x</a>.</p>')
+
+
+if __name__ == '__main__':
+    unittest.main()
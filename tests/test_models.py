@@ -0,0 +1,96 @@
+'''
+tests for models, they need the App Engine SDK on the python path.
+'''
+
+import re
+import unittest
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+
+import models
+
+
+class DatastoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        models.Item.local_cache.clear()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+
+class LegacyItemTest(DatastoreTestCase):
+    def legacy_item(self, **fields):
+        old = db.Expando()
+        for name, value in fields.items():
+            setattr(old, name, value)
+        return old.put()
+
+    def test_migrate_skips_items_without_an_account(self):
+        empty = self.legacy_item(account=u'', amount=u'5.00', text=u'no account')
+        missing = self.legacy_item(amount=u'5.00', text=u'no account either')
+        good = self.legacy_item(account=u'812-111-1111', amount=u'5.00', text=u'*hi*')
+
+        models.migrate_legacy_items()
+
+        self.assertEqual(models.Item.get_by_key_name(str(empty)), None)
+        self.assertEqual(models.Item.get_by_key_name(str(missing)), None)
+        item = models.Item.get_by_key_name(str(good))
+        self.assertEqual(item.account, u'812-111-1111')
+        self.assertEqual(item.url_key(), str(good))
+        self.assertEqual(models.Item.get_cached(str(empty)), None)
+
+    def test_invalid_legacy_amount_falls_back(self):
+        for amount in [u'NaN', u'Infinity', u'1e30', u'-5', u'']:
+            key = self.legacy_item(account=u'812-111-1111', amount=amount)
+            self.assertEqual(models.Item.from_legacy(key).amount, models.Decimal('1.00'))
+
+
+class SlugTest(DatastoreTestCase):
+    def test_base62_round_trip(self):
+        for n in [1, 9, 10, 61, 62, 63, 3843, 3844, 10 ** 6, 2 ** 62]:
+            slug = models.base62_encode(n)
+            self.assertEqual(models.base62_decode(slug), n)
+        self.assertEqual(models.base62_encode(61), 'Z')
+        self.assertEqual(models.base62_encode(62), '10')
+
+    def test_invalid_slugs(self):
+        self.assertRaises(ValueError, models.base62_decode, 'a-b')
+        self.assertEqual(models.Item.get_by_slug('favicon.ico'), None)
+        self.assertEqual(models.Item.get_by_slug('0'), None)
+        self.assertEqual(models.Item.get_by_slug('zzz'), None)
+
+    def test_created_item_is_found_by_its_slug(self):
+        item = models.Item.create(u'812-111-1111', u'5', u'thanks')
+        item.put()
+        self.assertEqual(item.url_path(), '/' + item.slug)
+        found = models.Item.get_by_slug(item.slug)
+        self.assertEqual((found.key(), found.amount), (item.key(), models.Decimal('5.00')))
+
+    def test_allocate_id_skips_reserved_slugs(self):
+        ids = [models.base62_decode(slug) for slug in ['new', 'login']] + [12345]
+        allocate_ids = models.db.allocate_ids
+        models.db.allocate_ids = lambda key, size: (ids.pop(0), 0)
+        try:
+            self.assertEqual(models.Item.allocate_id(), 12345)
+        finally:
+            models.db.allocate_ids = allocate_ids
+
+    def test_routes_that_look_like_slugs_are_reserved(self):
+        import main
+        for route in main.app_routes:
+            if isinstance(route, tuple) and re.match(r'^/[0-9a-zA-Z]+$', route[0]):
+                self.assertTrue(route[0][1:] in models.RESERVED_SLUGS, route[0])
+
+    def test_reserved_slug_items_link_by_key(self):
+        item = models.Item.create(u'812-111-1111', u'5', u'',
+            key=models.db.Key.from_path('Item', models.base62_decode('confirm')))
+        item.put()
+        self.assertEqual(item.url_path(), '/?k=%s' % item.key())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+'''
+tests for payments and the /confirm callback, they need the App Engine
+SDK on the python path.
+'''
+
+import os
+import hmac
+import json
+import hashlib
+import unittest
+import webapp2
+from google.appengine.api import taskqueue
+from google.appengine.ext import testbed
+
+import main
+import payments
+from models import Payment
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def notification(checkout_id='c1', status='Completed', amount=5.0, **fields):
+    data = {'CheckoutId': checkout_id, 'Amount': amount, 'Status': status,
+        'OrderId': 'item1', 'TransactionId': '123', 'TestMode': 'false'}
+    data['Signature'] = hmac.new(main.app.config['DWOLLA_API_SECRET'],
+        '%s&%s' % (checkout_id, float(amount)), hashlib.sha1).hexdigest()
+    data.update(fields)
+    return data
+
+
+def tasks(*notifications):
+    return [taskqueue.Task(payload=json.dumps(n), method='PULL') for n in notifications]
+
+
+class PaymentsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        self.queue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def status(self, checkout_id='c1'):
+        return Payment.get(Payment.key_for(checkout_id)).status
+
+
+class ParseTest(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(payments.parse('{"CheckoutId": "c1", "Amount": 5}'),
+            {'CheckoutId': 'c1', 'Amount': 5})
+
+    def test_parse_rejects_other_payloads(self):
+        for payload in ['', 'not json', '[1, 2]', '"c1"', '{"Amount": 5}',
+                '{"CheckoutId": ""}']:
+            self.assertRaises(ValueError, payments.parse, payload)
+
+
+class ConfirmHandlerTest(PaymentsTestCase):
+    def post(self, body):
+        request = webapp2.Request.blank('/confirm', POST=body)
+        request.method = 'POST'
+        return request.get_response(main.app)
+
+    def queued(self):
+        return self.queue.GetTasks(payments.QUEUE)
+
+    def test_valid_notification_is_queued(self):
+        response = self.post(json.dumps(notification()))
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(len(self.queued()), 1)
+
+    def test_bad_or_missing_signature_is_forbidden(self):
+        for n in [notification(Signature='0' * 40), notification(Signature=''),
+                notification(Amount=6.0)]:
+            self.assertEqual(self.post(json.dumps(n)).status_int, 403)
+        n = notification()
+        del n['Signature']
+        self.assertEqual(self.post(json.dumps(n)).status_int, 403)
+        self.assertEqual(len(self.queued()), 0)
+
+    def test_malformed_body_is_a_bad_request(self):
+        self.assertEqual(self.post('checkout=c1').status_int, 400)
+        self.assertEqual(len(self.queued()), 0)
+
+
+class SaveTest(PaymentsTestCase):
+    def test_process_saves_queued_notifications(self):
+        payments.enqueue(json.dumps(notification('c1')))
+        payments.enqueue(json.dumps(notification('c2', 'Failed', Error='declined')))
+        self.assertEqual(payments.process(), 2)
+        payment = Payment.get(Payment.key_for('c2'))
+        self.assertEqual((payment.status, payment.error), ('Failed', 'declined'))
+        self.assertEqual(self.status('c1'), 'Completed')
+        self.assertEqual(Payment.get(Payment.key_for('c1')).transaction_id, 123)
+
+    def test_late_failure_in_the_same_batch_does_not_undo_completed(self):
+        payments.save(tasks(notification(status='Completed'), notification(status='Failed')))
+        self.assertEqual(self.status(), 'Completed')
+
+    def test_late_failure_in_a_later_batch_does_not_undo_completed(self):
+        payments.save(tasks(notification(status='Completed')))
+        payments.save(tasks(notification(status='Failed')))
+        payments.save(tasks(notification(status='Pending')))
+        self.assertEqual(self.status(), 'Completed')
+
+    def test_completed_replaces_failed(self):
+        payments.save(tasks(notification(status='Failed')))
+        payments.save(tasks(notification(status='Completed')))
+        self.assertEqual(self.status(), 'Completed')
+        self.assertEqual(Payment.all().count(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+'''
+tests for payouts, they need the App Engine SDK on the python path.
+'''
+
+import unittest
+from google.appengine.ext import testbed
+
+import dwolla
+import payouts
+from models import PayoutBatch, PayoutRow
+
+ROWS = [('812-222-2222', '5.00', 'thanks!'), ('812-333-3333', '2.50', '')]
+
+
+class FakeAPI(object):
+    '''the parts of `DwollaUser` used by `BulkPayout`'''
+    def __init__(self):
+        self.transactions = []
+        # dest -> exception to raise on the next send to it
+        self.errors = {}
+
+    def send_funds(self, amount, dest, pin, notes=None, **kwargs):
+        if dest in self.errors:
+            raise self.errors.pop(dest)
+        tx_id = 1000 + len(self.transactions)
+        self.transactions.append({'Id': tx_id, 'Amount': amount,
+            'DestinationId': dest, 'Notes': notes})
+        return tx_id
+
+    def iter_transactions(self, since="", types=""):
+        return iter(list(self.transactions))
+
+    def sent_to(self, dest):
+        return [tx for tx in self.transactions if tx['DestinationId'] == dest]
+
+
+class BulkPayoutTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.api = FakeAPI()
+        self.payouts = payouts.BulkPayout(self.api, '1234')
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def rows(self, batch):
+        return dict((row.dest, row) for row in self.payouts.get_rows(batch))
+
+    def test_create_batch_again_after_a_crash(self):
+        put = PayoutBatch.put
+        def crash(self, *args, **kwargs):
+            raise RuntimeError("instance went away")
+        PayoutBatch.put = crash
+        try:
+            self.assertRaises(RuntimeError, self.payouts.create_batch, ROWS)
+        finally:
+            PayoutBatch.put = put
+        # the rows were written, but there's no batch to run them
+        self.assertEqual(PayoutRow.all().count(), 2)
+        self.assertEqual(PayoutBatch.all().count(), 0)
+
+        batch = self.payouts.create_batch(ROWS)
+        report = self.payouts.run(batch)
+        self.assertEqual(report['sent'], 2)
+        self.assertEqual(len(self.api.transactions), 2)
+        self.assertEqual(PayoutBatch.get(batch.key()).status, 'done')
+
+    def test_request_not_sent_goes_back_to_pending(self):
+        batch = self.payouts.create_batch(ROWS)
+        self.api.errors['812-222-2222'] = dwolla.CircuitOpenError("open")
+        report = self.payouts.run(batch)
+        self.assertEqual((report['pending'], report['sent']), (1, 1))
+        self.assertEqual(self.rows(batch)['812-222-2222'].status, 'pending')
+        self.assertEqual(PayoutBatch.get(batch.key()).status, 'running')
+
+        report = self.payouts.run(batch)
+        self.assertEqual(report['sent'], 2)
+        self.assertEqual(len(self.api.sent_to('812-222-2222')), 1)
+
+    def test_unavailable_stays_sending_until_reconciled(self):
+        batch = self.payouts.create_batch(ROWS)
+        self.api.errors['812-222-2222'] = dwolla.DwollaUnavailableError("503", 503)
+        report = self.payouts.run(batch)
+        self.assertEqual((report['sending'], report['sent']), (1, 1))
+        self.assertEqual(self.rows(batch)['812-222-2222'].status, 'sending')
+
+        # it never reached dwolla, so reconcile puts it back and it's sent
+        report = self.payouts.run(batch)
+        self.assertEqual(report['sent'], 2)
+        self.assertEqual(len(self.api.sent_to('812-222-2222')), 1)
+
+    def test_reconcile_finds_a_sent_row_by_its_ref(self):
+        batch = self.payouts.create_batch(ROWS)
+        row = self.rows(batch)['812-222-2222']
+        # the send went through, but the run crashed before saving that
+        tx_id = self.api.send_funds(5.0, row.dest, '1234', notes=self.payouts.notes(row))
+        row.status = 'sending'
+        row.put()
+
+        report = self.payouts.run(batch)
+        self.assertEqual(report['sent'], 2)
+        self.assertEqual(len(self.api.sent_to('812-222-2222')), 1)
+        row = self.rows(batch)['812-222-2222']
+        self.assertEqual((row.status, row.transaction_id), ('sent', tx_id))
+
+
+if __name__ == '__main__':
+    unittest.main()
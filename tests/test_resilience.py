@@ -0,0 +1,92 @@
+'''
+tests for dwolla.resilience, run with:
+
+    python -m unittest discover tests
+'''
+
+import time
+import unittest
+
+import dwolla
+from dwolla.resilience import CircuitBreaker, TokenBucket, ResilientTransport
+from dwolla.transport import Response
+
+
+class FailingTransport(dwolla.Transport):
+    def __init__(self):
+        self.status = 503
+        self.sent = 0
+
+    def fetch(self, url, method='GET', payload=None, headers=None, deadline=None):
+        self.sent += 1
+        return Response(self.status, '{}')
+
+
+class NeverDoneRPC(object):
+    def get_result(self):
+        raise AssertionError("nobody collects this")
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def open_breaker(self, transport, breaker, limiter=None):
+        client = ResilientTransport(transport, limiter=limiter, breaker=breaker)
+        for i in range(breaker.threshold):
+            self.assertRaises(dwolla.DwollaUnavailableError, client.fetch, 'http://x/')
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        return client
+
+    def test_rate_limited_trial_does_not_wedge_breaker(self):
+        transport = FailingTransport()
+        breaker = CircuitBreaker(threshold=2, reset_timeout=0.05)
+        limiter = TokenBucket(rate=1000, burst=2)
+        client = self.open_breaker(transport, breaker, limiter)
+        time.sleep(0.06)
+
+        # no tokens left: the trial must not be used up by this call
+        limiter.tokens = 0
+        limiter.rate = 0.001
+        client.max_wait = 0
+        self.assertRaises(dwolla.RateLimitError, client.fetch, 'http://x/')
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        limiter.rate = 1000
+        limiter.tokens = 2
+        transport.status = 200
+        client.fetch('http://x/')
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_open_breaker_fails_fast_without_taking_a_token(self):
+        transport = FailingTransport()
+        breaker = CircuitBreaker(threshold=2, reset_timeout=60)
+        limiter = TokenBucket(rate=1000, burst=2)
+        client = self.open_breaker(transport, breaker, limiter)
+
+        # an empty bucket that would make a request wait for max_wait
+        limiter.tokens = 0
+        limiter.rate = 1.5
+        start = time.time()
+        self.assertRaises(dwolla.CircuitOpenError, client.fetch, 'http://x/')
+        self.assertTrue(time.time() - start < 0.1)
+        self.assertTrue(limiter.tokens < 0.5)
+        self.assertEqual(transport.sent, 2)
+
+    def test_abandoned_trial_is_retried_after_reset_timeout(self):
+        transport = FailingTransport()
+        transport.fetch_async = lambda *args, **kwargs: NeverDoneRPC()
+        breaker = CircuitBreaker(threshold=2, reset_timeout=0.05)
+        client = self.open_breaker(transport, breaker)
+        time.sleep(0.06)
+
+        # the trial goes out async, and its result is never asked for
+        client.fetch_async('http://x/')
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertRaises(dwolla.CircuitOpenError, client.fetch, 'http://x/')
+
+        time.sleep(0.06)
+        transport.status = 200
+        client.fetch('http://x/')
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+'''
+tests for dwolla.singleflight
+'''
+
+import time
+import threading
+import unittest
+
+from dwolla.singleflight import SingleFlight
+
+
+class Boom(BaseException):
+    '''not an `Exception`, like App Engine's DeadlineExceededError'''
+    pass
+
+
+class SingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        self.group = SingleFlight()
+        self.release = threading.Event()
+        self.calls = 0
+
+    def slow(self, result=None, error=None):
+        def fn():
+            self.calls += 1
+            self.release.wait(5)
+            if error is not None:
+                raise error
+            return result
+        return fn
+
+    def run_callers(self, fn, n=4):
+        '''calls `fn` from `n` threads at once, returns their outcomes'''
+        outcomes = [None] * n
+
+        def call(i):
+            try:
+                outcomes[i] = ('ok', self.group.do('key', fn))
+            except BaseException as e:
+                outcomes[i] = ('error', e)
+
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(n)]
+        threads[0].start()
+        while not self.group.in_flight():
+            time.sleep(0.001)
+        for t in threads[1:]:
+            t.start()
+        while self.group.coalesced < n - 1:
+            time.sleep(0.001)
+        self.release.set()
+        for t in threads:
+            t.join(5)
+        return outcomes
+
+    def test_concurrent_callers_share_one_call(self):
+        outcomes = self.run_callers(self.slow({'Id': 1}))
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(outcomes, [('ok', {'Id': 1})] * 4)
+        self.assertEqual(self.group.in_flight(), 0)
+
+    def test_waiters_get_the_leaders_exception(self):
+        for error in [ValueError("bad"), Boom()]:
+            self.group.coalesced = 0
+            self.release.clear()
+            outcomes = self.run_callers(self.slow(error=error))
+            self.assertEqual([o[0] for o in outcomes], ['error'] * 4)
+            for kind, e in outcomes:
+                self.assertTrue(e is error)
+
+    def test_each_waiter_gets_its_own_copy(self):
+        outcomes = self.run_callers(self.slow({'Contacts': [1, 2]}))
+        results = [result for kind, result in outcomes]
+        results[0]['Contacts'].append(3)
+        for result in results[1:]:
+            self.assertEqual(result, {'Contacts': [1, 2]})
+        ids = set(id(r) for r in results) | set(id(r['Contacts']) for r in results)
+        self.assertEqual(len(ids), 8)
+
+    def test_later_calls_run_again(self):
+        self.release.set()
+        self.group.do('key', self.slow(1))
+        self.group.do('key', self.slow(2))
+        self.assertEqual(self.calls, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()